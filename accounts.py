@@ -0,0 +1,93 @@
+"""accounts.py - Creating Users and migrating them to name keys.
+
+A User is stored under a key derived from its name (see User.key_for), so a
+name is unique by construction: create_user inserts the User in a
+transaction that first checks the key is free, and looking a player up by
+name is a key get rather than a query (see cache.get_user_key).
+
+Users created before that have numeric ids. migrate_batch moves them to
+name keys: it creates the name-keyed User, points the old User's Games,
+archived Games and Scores at it, recomputes its ranking aggregates from
+those Scores and deletes the old User. Each step can be repeated, so a
+retried batch is harmless, and two old Users with the same name are merged
+into one. Until the last batch records the migration as complete, names
+with no name-keyed User are also looked up by query (see
+cache.get_user_key)."""
+
+from google.appengine.ext import ndb
+
+import archive
+import cache
+import rankings
+from models import Migration, User, Game, Score
+
+MIGRATE_BATCH_SIZE = 20
+
+
+def create_user(name, email=None):
+    """Creates a User. Returns it, or None if the name is already taken"""
+    if cache.get_user_key(name):
+        return None
+    key = User.key_for(name)
+
+    def txn():
+        if key.get() is not None:
+            return None
+        user = User(key=key, name=name, email=email)
+        user.put()
+        return user
+    return ndb.transaction(txn)
+
+
+def migrate_batch(cursor=None):
+    """Migrates the numerically keyed Users among one batch of Users.
+    Returns the cursor of the next batch, or None when done"""
+    users, next_cursor, more = User.query().fetch_page(
+        MIGRATE_BATCH_SIZE, start_cursor=cursor)
+    for user in users:
+        if user.key.id() != user.name:
+            _migrate(user)
+    if more:
+        return next_cursor
+    # Names without a name-keyed User need no longer be looked up by query.
+    Migration(id=cache.USERS_MIGRATION).put()
+    return None
+
+
+def _migrate(old):
+    key = User.key_for(old.name)
+
+    def create():
+        if key.get() is None:
+            User(key=key, name=old.name, email=old.email).put()
+    ndb.transaction(create)
+
+    def repoint(game_key):
+        game = game_key.get()
+        game.user = key
+        game.put()
+        cache.publish_later(game)
+        return game
+    # Games are rewritten in transactions so a concurrent move is retried
+    # rather than overwritten.
+    for game_key in Game.query(Game.user == old.key).fetch(keys_only=True):
+        cache.publish(ndb.transaction(lambda: repoint(game_key)))
+    archive.move(old.key, key)
+
+    # The moved Scores are counted directly: a query for them by their new
+    # User might not see them yet.
+    scores = dict((score.key, score)
+                  for score in Score.query(Score.user == key))
+    moved = Score.query(Score.user == old.key).fetch()
+    for score in moved:
+        score.user = key
+        scores[score.key] = score
+    ndb.put_multi(moved)
+
+    user = key.get()
+    if not user.email:
+        user.email = old.email
+    rankings.recompute(user, scores.values())
+    user.put()
+    old.key.delete()
+    cache.forget_user_key(old.name)
@@ -4,18 +4,30 @@ This can also contain game logic. For more complex games it would be wise to
 move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
-import operator
-import re
 import logging
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.api import oauth
+from google.appengine.api.datastore_errors import TransactionFailedError
 
-from models import User, Game, Score
+from models import Game, Score, User
 from models import StringMessage, NewGameForm, GameForm, GameForms, \
-    MakeMoveForm, ScoreForm, ScoreForms, UserForm, UserForms
-from utils import get_by_urlsafe
+    GameSummaryForms, HintForm, ImportForm, ImportJobForm, MakeMoveForm, \
+    MakeMovesForm, MoveResultForm, MovesForm, ScoreForm, ScoreForms, \
+    StatsForm, UserForm, UserForms
+from utils import get_key_by_urlsafe, fetch_page, fetch_page_async, \
+    DEFAULT_PAGE_SIZE
+import accounts
+import archive
+import bulk
+import cache
+import counters
+import debounce
+import hints
+import leaderboard
+import moves
+import rankings
+import stats
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -23,13 +35,62 @@ GET_GAME_REQUEST = endpoints.ResourceContainer(
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1, default=DEFAULT_PAGE_SIZE),
+    cursor=messages.StringField(2))
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2, default=DEFAULT_PAGE_SIZE),
+    cursor=messages.StringField(3))
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+    period=messages.StringField(1),
+    limit=messages.IntegerField(2, default=10))
+STATS_REQUEST = endpoints.ResourceContainer(
+    minutes=messages.IntegerField(1, default=stats.WINDOW_MINUTES))
+IMPORT_JOB_REQUEST = endpoints.ResourceContainer(
+    job_id=messages.IntegerField(1))
+
+
+def _check_admin():
+    """Raises unless the caller is signed in as an admin"""
+    if not endpoints.get_current_user():
+        raise endpoints.UnauthorizedException('Authorization required')
+    if not oauth.is_current_user_admin(endpoints.EMAIL_SCOPE):
+        raise endpoints.ForbiddenException('Admins only!')
+
+
+def _for_user(request, start):
+    """Returns start(user_key) for the User named in the request. Users are
+    keyed by name, so start runs for that key while the name is resolved;
+    it runs again only for a User not yet migrated to a name key. start
+    should return futures. Raises NotFoundException if there is no such
+    User"""
+    if not request.user_name:
+        raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+    named_key = User.key_for(request.user_name)
+    user_key = cache.get_user_key_async(request.user_name)
+    started = start(named_key)
+    user_key = user_key.get_result()
+    if not user_key:
+        raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+    if user_key != named_key:
+        started = start(user_key)
+    return started
 
-MEMCACHE_GAMES_ACTIVE = 'GAMES_ACTIVE'
 
-alphabet = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M',
-            'N', 'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z']
+def _fetch_user_page(model, request):
+    """Returns a page of a User's entities of model, and the next page's
+    cursor"""
+    return _for_user(request, lambda user_key: fetch_page_async(
+        model.query(model.user == user_key), request.page_size,
+        request.cursor)).get_result()
 
 
 @endpoints.api(name='hangman_api', version='v1')
@@ -41,13 +102,12 @@ class HangmanApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @stats.instrument
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if not accounts.create_user(request.user_name, request.email):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -56,194 +116,202 @@ class HangmanApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @stats.instrument
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        user_key = cache.get_user_key(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
         try:
-            game = Game.new_game(user.key, request.word_length)
+            game = moves.start_game(user_key, request.word_length)
         except ValueError:
             raise endpoints.BadRequestException('Word must be between '
                                                 '10 and 20!')
 
-        # Use a task queue to update the average attempts remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
-        return game.to_form('Hangman game started!')
+        # Use a task queue to reconcile the cached game counts with their
+        # shards. This operation is not needed to complete the creation of a
+        # new game so it is performed out of sequence, once per window
+        # however many games are started in it.
+        debounce.schedule('/tasks/cache_average_attempts')
+        return game.to_form('Hangman game started!', request.user_name)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @stats.instrument
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = cache.get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
+            user_name = cache.get_user_name(game.user)
             if game.game_over:
-                return game.to_form('The game is already over!')
+                return game.to_form('The game is already over!', user_name)
             elif game.cancelled:
-                return game.to_form('This game was cancelled!')
+                return game.to_form('This game was cancelled!', user_name)
             else:
-                return game.to_form('Time to make a move!')
+                return game.to_form('Time to make a move!', user_name)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @stats.instrument
+    def get_hint(self, request):
+        """Suggests the letter most likely to be in the word"""
+        game = cache.get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over or game.cancelled:
+            raise endpoints.BadRequestException('The game is already over!')
+        letter, candidates, matches = hints.get_hint(game)
+        form = HintForm(candidates=candidates)
+        if letter:
+            form.letter = letter
+            form.probability = float(matches) / candidates
+        return form
+
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @stats.instrument
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        guess = (request.guess).upper()
-        if game.game_over:
-            return game.to_form('Game already over!')
-
-        if game.cancelled:
-            return game.to_form('This game was cancelled!')
-
-        if len(guess) > 1:
-            return game.to_form('Invalid guess! You can only guess \
-                                one letter at a time!')
-
-        if guess not in alphabet:
-            return game.to_form('You need to enter a letter (A-Z)!')
-
-        letter_list = []
-        for m in re.finditer(guess, game.word):
-            letter_list.append(m.start())
-        number_matched = len(letter_list)
-
-        if guess in game.letters_guessed_correct:
-            msg = "You've already guessed " + guess + \
-                ", which is a correct letter."
-
-        elif guess in game.letters_guessed_wrong:
-            msg = "You've already guessed " + guess + \
-                ", which is an incorrect letter."
-
-        elif number_matched > 0:
-            game.add_correct_guess(guess)
-            correct_letters = set(''.join(game.letters_guessed_correct))
-            word_letters = set(game.word)
-            if len(correct_letters) == len(word_letters):
-                game.end_game(True)
-
-                rankings = {}
-                users = User.query().fetch()
-                for user in users:
-                    scores = Score.query(Score.user == user.key)
-                    number_of_games = scores.count()
-                    total_guesses = 0
-                    for score in scores:
-                        total_guesses += score.guesses
-                    rankings[user.key] = (total_guesses/number_of_games)
-                sorted_rankings = sorted(rankings.items(), key=operator.itemgetter(1))
-                for index, item in enumerate(sorted_rankings):
-                    rankings[sorted_rankings[index][0]] = index + 1
-                for user in users:
-                    for rank in rankings:
-                        if user.key == rank:
-                            user.ranking = rankings[rank]
-                            user.put()
-
-                return game.to_form('You win!')
-
-            if number_matched > 1:
-                msg = "You guessed correct. There are " + \
-                    str(number_matched) + " " + guess + "'s"
-            else:
-                msg = "You guessed correct. There is " + \
-                    str(number_matched) + " " + guess + "'s"
-        else:
-            game.attempts_remaining -= 1
-            game.add_wrong_guess(guess)
-            msg = "Wrong! There are no " + guess + "'s" + \
-                " in this word."
-
-        if game.attempts_remaining < 1:
-            game.end_game(False)
-            rankings = {}
-            users = User.query().fetch()
-            for user in users:
-                scores = Score.query(Score.user == user.key)
-                number_of_games = scores.count()
-                total_guesses = 0
-                for score in scores:
-                    total_guesses += score.guesses
-                rankings[user.key] = (total_guesses/number_of_games)
-            sorted_rankings = sorted(rankings.items(), key=operator.itemgetter(1))
-            for index, item in enumerate(sorted_rankings):
-                rankings[sorted_rankings[index][0]] = index + 1
-            for user in users:
-                for rank in rankings:
-                    if user.key == rank:
-                        user.ranking = rankings[rank]
-                        user.put()
-
-            return game.to_form(msg + ' Game over!')
-        else:
-            game.put()
-            return game.to_form(msg)
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        try:
+            game, msg = moves.make_move(game_key, (request.guess).upper())
+        except TransactionFailedError:
+            raise endpoints.ConflictException(
+                    'The game changed during the move, please try again!')
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        return game.to_form(msg, cache.get_user_name(game.user))
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MovesForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @stats.instrument
+    def make_moves(self, request):
+        """Makes several moves in order, stopping when the game ends. Returns
+        the final game state and the message of each move made"""
+        if not request.guesses:
+            raise endpoints.BadRequestException('No guesses given!')
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        try:
+            game, results = moves.make_moves(
+                game_key, [guess.upper() for guess in request.guesses])
+        except ValueError:
+            raise endpoints.BadRequestException(
+                    'At most {} guesses can be made at once!'.format(
+                        moves.MAX_GUESSES))
+        except TransactionFailedError:
+            raise endpoints.ConflictException(
+                    'The game changed during the moves, please try again!')
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        return MovesForm(game=game.to_form(results[-1][1],
+                                           cache.get_user_name(game.user)),
+                         results=[MoveResultForm(guess=guess, message=msg)
+                                  for guess, msg in results])
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @stats.instrument
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return all scores, one page at a time"""
+        scores, next_cursor = fetch_page(Score.query(), request.page_size,
+                                         request.cursor)
+        return Score.to_forms(scores, next_cursor)
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @stats.instrument
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                    'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Returns all of an individual User's scores, one page at a time"""
+        scores, next_cursor = _fetch_user_page(Score, request)
+        return ScoreForms(items=[score.to_form(request.user_name)
+                                 for score in scores],
+                          next_cursor=next_cursor)
 
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @stats.instrument
     def get_user_games(self, request):
-        """Returns all of a User's games (both active and inactive)"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key)
+        """Returns all of a User's games (both active and inactive), one page
+        at a time"""
+        games, archived, next_cursor = _for_user(
+            request, lambda user_key: archive.fetch_history_async(
+                Game.query(Game.user == user_key), user_key,
+                request.page_size, request.cursor)).get_result()
         null_message = None
-        return GameForms(games=[game.to_form(null_message) for game in games])
+        return GameForms(games=[game.to_form(null_message, request.user_name)
+                                for game in games] +
+                         [archive.to_form(entry, request.user_name)
+                          for entry in archived],
+                         next_cursor=next_cursor)
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
+                      response_message=GameSummaryForms,
+                      path='games/user/{user_name}/summary',
+                      name='get_user_game_summaries',
+                      http_method='GET')
+    @stats.instrument
+    def get_user_game_summaries(self, request):
+        """Returns a User's numbers of active, finished and cancelled games
+        and one page of compact summaries of their games"""
+        page, counts, archived_counts = _for_user(
+            request, lambda user_key: (
+                archive.fetch_history_async(Game.summary_query(user_key),
+                                            user_key, request.page_size,
+                                            request.cursor),
+                Game.count_for_user_async(user_key),
+                archive.count_async(user_key)))
+        games, archived, next_cursor = page.get_result()
+        active, finished, cancelled = counts.get_result()
+        archived_finished, archived_cancelled = archived_counts.get_result()
+        return GameSummaryForms(
+            user_name=request.user_name, active=active,
+            finished=finished + archived_finished,
+            cancelled=cancelled + archived_cancelled,
+            games=[game.to_summary_form() for game in games] +
+            [archive.to_summary_form(entry) for entry in archived],
+            next_cursor=next_cursor)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}/cancel',
                       name='cancel_game',
                       http_method='PUT')
+    @stats.instrument
     def cancel_game(self, request):
         """Cancel's the game"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game = moves.cancel_game(game_key)
         if game:
+            user_name = cache.get_user_name(game.user)
             if game.game_over:
-                return game.to_form('The game is already over, and cannot be deleted')
+                return game.to_form('The game is already over, and cannot be deleted', user_name)
             else:
-                game.cancel_game()
-                game.put()
-                return game.to_form("Game has been cancelled!")
+                return game.to_form("Game has been cancelled!", user_name)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
@@ -252,40 +320,113 @@ class HangmanApi(remote.Service):
                       path='highscores',
                       name='get_high_scores',
                       http_method='GET')
+    @stats.instrument
     def get_high_scores(self, request):
         """Return high scores"""
-        scores = Score.query(Score.won == True).order(Score.guesses).fetch(request.number_of_records)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        return ScoreForms(items=leaderboard.get_high_scores(
+            request.number_of_records))
+
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=ScoreForms,
+                      path='leaderboard/{period}',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @stats.instrument
+    def get_leaderboard(self, request):
+        """Return the best scores of today, this week or all time"""
+        try:
+            return ScoreForms(items=leaderboard.get_leaderboard(
+                request.period, request.limit))
+        except ValueError:
+            raise endpoints.BadRequestException(
+                    'Period must be one of {}!'.format(
+                        ', '.join(leaderboard.PERIODS)))
 
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserForms,
                       path='rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @stats.instrument
     def get_user_rankings(self, request):
-        """Return a list of ranked players scores"""
-        users = User.query().order(User.ranking).fetch()
-        return UserForms(rankings=[user.to_form() for user in users])
+        """Return a list of ranked players scores, one page at a time"""
+        ranked, next_cursor = rankings.ranked_page(request.page_size,
+                                                   request.cursor)
+        return UserForms(rankings=[user.to_form(ranking)
+                                   for ranking, user in ranked],
+                         next_cursor=next_cursor)
 
 
     @staticmethod
     def cache_active_games():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query().fetch()
-        if games:
-            count_games = games.count()
-            memcache.set(MEMCACHE_GAMES_ACTIVE,
-                         'The number of active games is {:.2f}'
-                         .format(count_games))
+        """Recomputes the cached number of active Games from its shards"""
+        counters.refresh([counters.ACTIVE_GAMES])
 
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_active_game_count',
                       http_method='GET')
+    @stats.instrument
     def get_active_game_count(self, request):
         """Get the cached number of active games"""
-        return StringMessage(message=memcache.get(MEMCACHE_GAMES_ACTIVE) or
-                             'There are no active games at the moment')
+        count = counters.get_count(counters.ACTIVE_GAMES)
+        if not count:
+            return StringMessage(
+                message='There are no active games at the moment')
+        return StringMessage(
+            message='The number of active games is {}'.format(count))
+
+    @endpoints.method(request_message=STATS_REQUEST,
+                      response_message=StatsForm,
+                      path='admin/stats',
+                      name='get_stats',
+                      http_method='GET')
+    def get_stats(self, request):
+        """Return each endpoint's calls, latency and RPCs over the last
+        minutes (at most 60). Admins only"""
+        _check_admin()
+        if not 0 < request.minutes <= stats.WINDOW_MINUTES:
+            raise endpoints.BadRequestException(
+                    'minutes must be between 1 and {}!'.format(
+                        stats.WINDOW_MINUTES))
+        return stats.get_stats(request.minutes)
+
+    @endpoints.method(request_message=ImportForm,
+                      response_message=ImportJobForm,
+                      path='admin/import',
+                      name='import_records',
+                      http_method='POST')
+    def import_records(self, request):
+        """Bulk-import Users, Games and Scores, in parts: omit job_id to
+        start an import, pass it with the later parts and set final on the
+        last. Admins only"""
+        _check_admin()
+        try:
+            job = bulk.add_records(request.job_id, request.users,
+                                   request.games, request.scores,
+                                   request.final)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        except TransactionFailedError:
+            raise endpoints.ConflictException(
+                    'The import changed during the request, please try again!')
+        if not job:
+            raise endpoints.NotFoundException('Import not found!')
+        return bulk.to_form(job)
+
+    @endpoints.method(request_message=IMPORT_JOB_REQUEST,
+                      response_message=ImportJobForm,
+                      path='admin/import/{job_id}',
+                      name='get_import',
+                      http_method='GET')
+    def get_import(self, request):
+        """Return the progress of a bulk import. Admins only"""
+        _check_admin()
+        job = bulk.get_job(request.job_id) if request.job_id else None
+        if not job:
+            raise endpoints.NotFoundException('Import not found!')
+        return bulk.to_form(job)
 
 
 api = endpoints.api_server([HangmanApi])
@@ -0,0 +1,231 @@
+"""archive.py - Archival of long-ended Games.
+
+Games that finished or were cancelled more than ARCHIVE_AFTER_DAYS ago are
+moved into GameArchive entities: compact [urlsafe key, result, guesses,
+date, word length] entries (entries archived before the word length was
+kept have only the first four), up to ARCHIVE_SIZE to an entity, kept as
+numbered children of the player's User. Each Game is deleted in the same
+cross-group transaction that archives it, so a Game is never lost or
+archived twice. A transaction may span 25 entity groups, so it takes at
+most TXN_GAMES Games. The daily archive_games cron runs archive_batch in a
+chain of tasks until no Game is left to archive.
+
+fetch_history_async pages through a User's live Games and then their
+archive, so the game listings read both transparently."""
+
+import collections
+import datetime
+
+import endpoints
+from google.appengine.ext import ndb
+
+import cache
+from models import ATTEMPTS_ALLOWED, Game, GameArchive, GameForm, \
+    GameSummaryForm
+from utils import clamp_page_size, fetch_page_async
+
+ARCHIVE_AFTER_DAYS = 30
+# At least MAX_PAGE_SIZE, so a page spans at most two GameArchives.
+ARCHIVE_SIZE = 500
+BATCH_SIZE = 100
+TXN_GAMES = 24
+STAMP_BATCH_SIZE = 100
+CURSOR_PREFIX = 'archive.'
+WON = 'won'
+LOST = 'lost'
+CANCELLED = 'cancelled'
+
+
+def _entry(game):
+    if game.cancelled:
+        result = CANCELLED
+    elif game.is_solved():
+        result = WON
+    else:
+        result = LOST
+    return [game.key.urlsafe(), result,
+            game.attempts_allowed - game.attempts_remaining, str(game.ended),
+            game.word_length]
+
+
+def _append(user_key, entries):
+    """Appends entries to a User's archive. Call it in a transaction.
+    Returns the GameArchives to put"""
+    keys = GameArchive.query(ancestor=user_key).fetch(keys_only=True)
+    last = None
+    if keys:
+        last = max(keys, key=lambda key: key.id()).get()
+    if last is None:
+        last = GameArchive(parent=user_key, id=1)
+    changed = [last]
+    batch = list(last.entries)
+    for entry in entries:
+        if len(batch) >= ARCHIVE_SIZE:
+            last.entries = batch
+            last = GameArchive(parent=user_key, id=last.key.id() + 1,
+                               finished=last.finished,
+                               cancelled=last.cancelled)
+            changed.append(last)
+            batch = []
+        batch.append(entry)
+        if entry[1] == CANCELLED:
+            last.cancelled += 1
+        else:
+            last.finished += 1
+    last.entries = batch
+    return changed
+
+
+def _archive(user_key, game_keys):
+    """Moves Games of one User into their archive in one transaction.
+    Returns the keys of the Games archived"""
+    @ndb.transactional(xg=True)
+    def txn():
+        games = [game for game in ndb.get_multi(game_keys)
+                 if game is not None]
+        if not games:
+            return []
+        ndb.put_multi(_append(user_key, [_entry(game) for game in games]))
+        archived = [game.key for game in games]
+        ndb.delete_multi(archived)
+        return archived
+    return txn()
+
+
+def archive_batch():
+    """Archives one batch of the Games that ended more than
+    ARCHIVE_AFTER_DAYS ago. Returns True if there may be more"""
+    cutoff = datetime.date.today() - datetime.timedelta(
+        days=ARCHIVE_AFTER_DAYS)
+    games = Game.query(Game.ended < cutoff,
+                       projection=[Game.user]).fetch(BATCH_SIZE)
+    by_user = collections.defaultdict(list)
+    for game in games:
+        by_user[game.user].append(game.key)
+    archived = []
+    for user_key, game_keys in by_user.items():
+        for start in range(0, len(game_keys), TXN_GAMES):
+            archived.extend(_archive(user_key,
+                                     game_keys[start:start + TXN_GAMES]))
+    cache.forget(archived)
+    return len(games) == BATCH_SIZE
+
+
+def stamp_batch(cursor=None):
+    """Dates the ended Games among one batch of Games that were stored
+    before Games recorded when they ended, so they can be archived. Returns
+    the cursor of the next batch, or None when done"""
+    games, next_cursor, more = Game.query().fetch_page(
+        STAMP_BATCH_SIZE, start_cursor=cursor)
+    stamped = [game for game in games
+               if (game.game_over or game.cancelled) and game.ended is None]
+    for game in stamped:
+        game.ended = datetime.date.today()
+    # Ended Games no longer change, so there is no move to overwrite.
+    ndb.put_multi(stamped)
+    for game in stamped:
+        cache.publish(game)
+    return next_cursor if more else None
+
+
+def move(old_user_key, new_user_key):
+    """Appends one User's archive to another's, as when a User is
+    migrated"""
+    @ndb.transactional(xg=True)
+    def txn():
+        batches = sorted(GameArchive.query(ancestor=old_user_key),
+                         key=lambda batch: batch.key.id())
+        if not batches:
+            return
+        entries = []
+        for batch in batches:
+            entries.extend(batch.entries)
+        ndb.put_multi(_append(new_user_key, entries))
+        ndb.delete_multi([batch.key for batch in batches])
+    txn()
+
+
+@ndb.tasklet
+def count_async(user_key):
+    """Returns a Future of a User's numbers of archived finished and
+    cancelled Games"""
+    keys = yield GameArchive.query(ancestor=user_key).fetch_async(
+        keys_only=True)
+    if not keys:
+        raise ndb.Return((0, 0))
+    last = yield max(keys, key=lambda key: key.id()).get_async()
+    raise ndb.Return((last.finished, last.cancelled))
+
+
+def totals():
+    """Returns the numbers of archived finished and cancelled Games across
+    all Users, and a dict of word length -> number of archived Games of that
+    length"""
+    last = {}
+    lengths = collections.Counter()
+    for batch in GameArchive.query():
+        user_key = batch.key.parent()
+        if user_key not in last or batch.key.id() > last[user_key].key.id():
+            last[user_key] = batch
+        lengths.update(entry[4] for entry in batch.entries if len(entry) > 4)
+    return (sum(batch.finished for batch in last.values()),
+            sum(batch.cancelled for batch in last.values()),
+            dict(lengths))
+
+
+@ndb.tasklet
+def fetch_history_async(query, user_key, page_size, cursor):
+    """Returns a Future of one page of a User's game history: the results
+    of query, over the User's live Games, followed by their archive entries,
+    oldest first. The Future's result is (games, entries, next_cursor)"""
+    page_size = clamp_page_size(page_size)
+    if cursor and cursor.startswith(CURSOR_PREFIX):
+        games = []
+        try:
+            number, offset = [int(part) for part in
+                              cursor[len(CURSOR_PREFIX):].split('.')]
+        except ValueError:
+            number, offset = 0, 0
+        if number < 1 or offset < 0:
+            raise endpoints.BadRequestException('Invalid cursor')
+    else:
+        games, next_cursor = yield fetch_page_async(query, page_size, cursor)
+        if next_cursor:
+            raise ndb.Return((games, [], next_cursor))
+        number, offset = 1, 0
+    entries = []
+    while len(games) + len(entries) < page_size:
+        batch = yield ndb.Key(GameArchive, number,
+                              parent=user_key).get_async()
+        if batch is None:
+            raise ndb.Return((games, entries, None))
+        taken = batch.entries[offset:
+                              offset + page_size - len(games) - len(entries)]
+        entries.extend(taken)
+        offset += len(taken)
+        if offset >= len(batch.entries):
+            if len(batch.entries) < ARCHIVE_SIZE:
+                raise ndb.Return((games, entries, None))
+            number, offset = number + 1, 0
+    raise ndb.Return((games, entries,
+                      '{}{}.{}'.format(CURSOR_PREFIX, number, offset)))
+
+
+def to_form(entry, user_name):
+    """Returns a GameForm of an archive entry"""
+    urlsafe_key, result, guesses = entry[:3]
+    return GameForm(urlsafe_key=urlsafe_key,
+                    attempts_remaining=max(ATTEMPTS_ALLOWED - guesses, 0),
+                    game_over=result != CANCELLED,
+                    cancelled=result == CANCELLED,
+                    user_name=user_name)
+
+
+def to_summary_form(entry):
+    """Returns a GameSummaryForm of an archive entry"""
+    urlsafe_key, result, guesses = entry[:3]
+    return GameSummaryForm(urlsafe_key=urlsafe_key,
+                           attempts_remaining=max(ATTEMPTS_ALLOWED - guesses,
+                                                  0),
+                           game_over=result != CANCELLED,
+                           cancelled=result == CANCELLED)
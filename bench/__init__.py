@@ -0,0 +1,2 @@
+"""Local benchmark harness: in-memory App Engine stand-ins (fakes), a
+population seeder and the endpoint benchmark runner (python -m bench.run)."""
@@ -0,0 +1 @@
+"""In-memory stand-ins for the App Engine services the game depends on."""
@@ -0,0 +1,73 @@
+"""apiproxy_stub_map.py - Stand-in for google.appengine.api.apiproxy_stub_map.
+
+Only the RPC hook lists are modelled. The other stand-ins report each
+simulated RPC through make_call(), which runs the hooks with request and
+response objects answering the size queries of the real protocol buffers
+(key_size(), entity_size(), result_size(), item_size()).
+"""
+
+
+class HookList(object):
+
+    def __init__(self):
+        self._hooks = []
+
+    def Append(self, key, function, service=None):
+        if any(k == key for k, _, _ in self._hooks):
+            return False
+        self._hooks.append((key, function, service))
+        return True
+
+    def Push(self, key, function, service=None):
+        if any(k == key for k, _, _ in self._hooks):
+            return False
+        self._hooks.insert(0, (key, function, service))
+        return True
+
+    def Clear(self):
+        del self._hooks[:]
+
+    def Call(self, service, call, request, response):
+        for _, function, only in list(self._hooks):
+            if only is None or only == service:
+                function(service, call, request, response)
+
+
+class APIProxyStubMap(object):
+
+    def __init__(self):
+        self._pre_call_hooks = HookList()
+        self._post_call_hooks = HookList()
+
+    def GetPreCallHooks(self):
+        return self._pre_call_hooks
+
+    def GetPostCallHooks(self):
+        return self._post_call_hooks
+
+
+apiproxy = APIProxyStubMap()
+
+
+class _Message(object):
+
+    def __init__(self, sizes):
+        self._sizes = sizes
+
+    def key_size(self):
+        return self._sizes.get('keys', 0)
+
+    def entity_size(self):
+        return self._sizes.get('entities', 0)
+
+    def result_size(self):
+        return self._sizes.get('results', 0)
+
+    def item_size(self):
+        return self._sizes.get('hits', 0)
+
+
+def make_call(service, call, sizes):
+    message = _Message(sizes)
+    apiproxy.GetPreCallHooks().Call(service, call, message, message)
+    apiproxy.GetPostCallHooks().Call(service, call, message, message)
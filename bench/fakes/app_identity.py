@@ -0,0 +1,9 @@
+"""app_identity.py - Stand-in for google.appengine.api.app_identity."""
+
+
+def get_application_id():
+    return 'hangman-bench'
+
+
+def get_default_version_hostname():
+    return 'localhost:8080'
@@ -0,0 +1,37 @@
+"""datastore_errors.py - Stand-in for google.appengine.api.datastore_errors."""
+
+
+class Error(Exception):
+    """Base datastore error."""
+
+
+class BadValueError(Error):
+    pass
+
+
+class BadArgumentError(Error):
+    pass
+
+
+class BadRequestError(Error):
+    pass
+
+
+class BadQueryError(Error):
+    pass
+
+
+class NeedIndexError(Error):
+    pass
+
+
+class Rollback(Error):
+    pass
+
+
+class TransactionFailedError(Error):
+    pass
+
+
+class Timeout(Error):
+    pass
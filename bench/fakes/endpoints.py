@@ -0,0 +1,113 @@
+"""endpoints.py - Stand-in for the Cloud Endpoints Frameworks library.
+
+Endpoint methods stay plain methods; the decorator records the request and
+response message classes so the harness can build requests and check that
+each method returns what it declares.
+"""
+
+import functools
+
+from protorpc import message_types, messages
+
+from bench.fakes import users
+
+API_EXPLORER_CLIENT_ID = 'api-explorer'
+EMAIL_SCOPE = 'https://www.googleapis.com/auth/userinfo.email'
+
+
+class ServiceException(Exception):
+    http_status = 400
+
+
+class BadRequestException(ServiceException):
+    http_status = 400
+
+
+class UnauthorizedException(ServiceException):
+    http_status = 401
+
+
+class ForbiddenException(ServiceException):
+    http_status = 403
+
+
+class NotFoundException(ServiceException):
+    http_status = 404
+
+
+class ConflictException(ServiceException):
+    http_status = 409
+
+
+class InternalServerErrorException(ServiceException):
+    http_status = 500
+
+
+def _copy_field(field, number):
+    kwds = {'required': field.required, 'repeated': field.repeated}
+    if not field.repeated and field.default is not None:
+        kwds['default'] = field.default
+    if isinstance(field, messages.MessageField):
+        return type(field)(field.message_type, number, **kwds)
+    if isinstance(field, messages.EnumField):
+        return type(field)(field.type, number, **kwds)
+    return type(field)(number, **kwds)
+
+
+class ResourceContainer(object):
+    """A request body message combined with path/query parameters."""
+
+    def __init__(self, _body_message=message_types.VoidMessage, **fields):
+        self.body_message_class = _body_message
+        self.parameters_message_class = type(
+            'Parameters', (messages.Message,), dict(fields))
+        combined = {}
+        number = 1
+        for field in _body_message.all_fields():
+            combined[field.name] = _copy_field(field, number)
+            number += 1
+        for name, field in sorted(fields.items(),
+                                  key=lambda kv: kv[1].number):
+            combined[name] = _copy_field(field, number)
+            number += 1
+        self.combined_message_class = type(
+            'Combined' + _body_message.__name__, (messages.Message,),
+            combined)
+
+
+def api(name=None, version=None, **kwds):
+    def decorator(cls):
+        cls.api_info = {'name': name, 'version': version}
+        return cls
+    return decorator
+
+
+def method(request_message=message_types.VoidMessage,
+           response_message=message_types.VoidMessage, name=None, path=None,
+           http_method='POST', **kwds):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request):
+            response = func(self, request)
+            if not isinstance(response, response_message):
+                raise TypeError('%s returned %r, expected %s' %
+                                (name, response, response_message.__name__))
+            response.check_initialized()
+            return response
+        if isinstance(request_message, ResourceContainer):
+            wrapper.request_class = request_message.combined_message_class
+        else:
+            wrapper.request_class = request_message
+        wrapper.response_class = response_message
+        wrapper.method_info = {'name': name or func.__name__, 'path': path,
+                               'http_method': http_method}
+        return wrapper
+    return decorator
+
+
+def get_current_user():
+    return users.get_current_user()
+
+
+def api_server(services, **kwds):
+    return {'services': list(services)}
@@ -0,0 +1,15 @@
+"""mail.py - Stand-in for google.appengine.api.mail that records messages."""
+
+from bench.fakes import runtime
+
+outbox = []
+
+
+def reset():
+    del outbox[:]
+
+
+def send_mail(sender, to, subject, body, **kwds):
+    runtime.record('mail', 'Send')
+    outbox.append({'sender': sender, 'to': to, 'subject': subject,
+                   'body': body})
@@ -0,0 +1,189 @@
+"""memcache.py - In-memory stand-in for google.appengine.api.memcache.
+
+Values are pickled on the way in and out, like the real service, so callers
+never share mutable state with the cache.
+"""
+
+import pickle
+import threading
+import time
+
+from bench.fakes import runtime
+
+_lock = threading.RLock()
+_data = {}
+
+
+def reset():
+    with _lock:
+        _data.clear()
+
+
+def _key(key, namespace):
+    return (namespace or '', key)
+
+
+def _expiry(seconds):
+    if not seconds:
+        return None
+    if seconds > 86400 * 30:
+        return seconds
+    return time.time() + seconds
+
+
+def _live(k):
+    item = _data.get(k)
+    if item is None:
+        return None
+    value, expires = item
+    if expires is not None and expires <= time.time():
+        del _data[k]
+        return None
+    return item
+
+
+def get(key, namespace=None, for_cas=False):
+    return get_multi([key], namespace=namespace).get(key)
+
+
+def get_multi(keys, key_prefix='', namespace=None, for_cas=False):
+    keys = list(keys)
+    result = {}
+    with _lock:
+        for key in keys:
+            item = _live(_key(key_prefix + key, namespace))
+            if item is not None:
+                result[key] = pickle.loads(item[0])
+    runtime.record('memcache', 'Get', keys=len(keys), hits=len(result))
+    runtime.count('memcache_hits', len(result))
+    runtime.count('memcache_misses', len(keys) - len(result))
+    return result
+
+
+def _store(mapping, time_, key_prefix, namespace, policy):
+    failed = []
+    with _lock:
+        for key, value in mapping.items():
+            k = _key(key_prefix + key, namespace)
+            present = _live(k) is not None
+            if (policy == 'add' and present) or \
+                    (policy == 'replace' and not present):
+                failed.append(key)
+                continue
+            _data[k] = (pickle.dumps(value, 2), _expiry(time_))
+    return failed
+
+
+def set(key, value, time=0, namespace=None):
+    return not set_multi({key: value}, time=time, namespace=namespace)
+
+
+def set_multi(mapping, time=0, key_prefix='', namespace=None):
+    runtime.record('memcache', 'Set', keys=len(mapping))
+    return _store(mapping, time, key_prefix, namespace, 'set')
+
+
+def add(key, value, time=0, namespace=None):
+    return not add_multi({key: value}, time=time, namespace=namespace)
+
+
+def add_multi(mapping, time=0, key_prefix='', namespace=None):
+    runtime.record('memcache', 'Set', keys=len(mapping))
+    return _store(mapping, time, key_prefix, namespace, 'add')
+
+
+def replace(key, value, time=0, namespace=None):
+    runtime.record('memcache', 'Set', keys=1)
+    return not _store({key: value}, time, '', namespace, 'replace')
+
+
+def delete(key, seconds=0, namespace=None):
+    return delete_multi([key], namespace=namespace) and 2 or 0
+
+
+def delete_multi(keys, seconds=0, key_prefix='', namespace=None):
+    runtime.record('memcache', 'Delete', keys=len(keys))
+    with _lock:
+        for key in keys:
+            _data.pop(_key(key_prefix + key, namespace), None)
+    return True
+
+
+def incr(key, delta=1, namespace=None, initial_value=None):
+    return offset_multi({key: delta}, namespace=namespace,
+                        initial_value=initial_value).get(key)
+
+
+def decr(key, delta=1, namespace=None, initial_value=None):
+    return incr(key, -delta, namespace=namespace,
+                initial_value=initial_value)
+
+
+def offset_multi(mapping, key_prefix='', namespace=None, initial_value=None):
+    runtime.record('memcache', 'Increment', keys=len(mapping))
+    result = {}
+    with _lock:
+        for key, delta in mapping.items():
+            k = _key(key_prefix + key, namespace)
+            item = _live(k)
+            if item is None:
+                if initial_value is None:
+                    result[key] = None
+                    continue
+                current, expires = initial_value, None
+            else:
+                current, expires = pickle.loads(item[0]), item[1]
+                if not isinstance(current, (int, long)):
+                    result[key] = None
+                    continue
+            current = max(0, current + delta)
+            _data[k] = (pickle.dumps(current, 2), expires)
+            result[key] = current
+    return result
+
+
+def offset_multi_async(mapping, key_prefix='', namespace=None,
+                       initial_value=None):
+    from bench.fakes import ndb
+    return ndb._completed(offset_multi, mapping, key_prefix=key_prefix,
+                          namespace=namespace, initial_value=initial_value)
+
+
+def flush_all():
+    reset()
+    return True
+
+
+def get_stats():
+    with _lock:
+        return {'items': len(_data)}
+
+
+class Client(object):
+    """Compare-and-set client."""
+
+    def __init__(self):
+        self._cas = {}
+
+    def gets(self, key, namespace=None):
+        with _lock:
+            item = _live(_key(key, namespace))
+            runtime.record('memcache', 'Get', keys=1,
+                           hits=0 if item is None else 1)
+            if item is None:
+                return None
+            self._cas[_key(key, namespace)] = item[0]
+            return pickle.loads(item[0])
+
+    def cas(self, key, value, time=0, namespace=None):
+        runtime.record('memcache', 'Set', keys=1)
+        k = _key(key, namespace)
+        with _lock:
+            item = _live(k)
+            if item is None or self._cas.get(k) != item[0]:
+                return False
+            _data[k] = (pickle.dumps(value, 2), _expiry(time))
+            return True
+
+    def __getattr__(self, name):
+        return globals()[name]
@@ -0,0 +1,1570 @@
+"""ndb.py - In-memory stand-in for google.appengine.ext.ndb.
+
+Implements the slice of ndb the game uses: models and properties, keys,
+queries with cursors/projections, transactions with optimistic concurrency,
+and synchronous futures/tasklets. Every operation is charged to the shared
+RPC ledger in fakes.runtime so benchmarks can report datastore RPCs per call.
+"""
+
+import base64
+import bisect
+import copy
+import datetime
+import functools
+import itertools
+import json
+import pickle
+import threading
+
+from bench.fakes import runtime
+from bench.fakes.datastore_errors import (BadArgumentError, BadQueryError,
+                                          BadRequestError, BadValueError,
+                                          Rollback, TransactionFailedError)
+
+
+# ---------------------------------------------------------------------------
+# Storage
+
+
+class _Store(object):
+    """The in-memory datastore: entity snapshots, entity-group versions and
+    the sorted indexes queries read from."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        self.entities = {}
+        self.group_versions = {}
+        self.ids = itertools.count(1)
+        self.indexes = {}
+
+    def write(self, pairs, record):
+        """Stores record, a (kind, values) snapshot, or deletes the entity
+        when record is None, keeping the kind's indexes in step."""
+        old = self.entities.pop(pairs, None)
+        if record is not None:
+            self.entities[pairs] = record
+        for index in self.indexes.get(pairs[-1][0], {}).values():
+            index.replace(pairs, old and old[1], record and record[1])
+        self.bump(pairs)
+
+    def index(self, kind, equality, orders):
+        """Returns the index of kind for the given equality filter names and
+        (name, descending) orders, building it on first use."""
+        indexes = self.indexes.setdefault(kind, {})
+        index = indexes.get((equality, orders))
+        if index is None:
+            index = indexes[(equality, orders)] = _Index(equality, orders)
+            index.build((pairs, values) for pairs, (entity_kind, values)
+                        in self.entities.items() if entity_kind == kind)
+        return index
+
+    def group_of(self, pairs):
+        return pairs[0]
+
+    def version(self, pairs):
+        return self.group_versions.get(self.group_of(pairs), 0)
+
+    def bump(self, pairs):
+        group = self.group_of(pairs)
+        self.group_versions[group] = self.group_versions.get(group, 0) + 1
+
+
+class _Descending(object):
+    """Wraps an index value so that it sorts in reverse."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __le__(self, other):
+        return self.value >= other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __ge__(self, other):
+        return self.value <= other.value
+
+
+class _Last(object):
+    """Sorts after every index value; bounds a range scan."""
+
+    def __eq__(self, other):
+        return other is self
+
+    def __ne__(self, other):
+        return other is not self
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return other is self
+
+    def __gt__(self, other):
+        return other is not self
+
+    def __ge__(self, other):
+        return True
+
+
+_LAST = _Last()
+
+
+class _Index(object):
+    """A sorted composite index, like the production datastore's: one
+    (equality values, order values, key) entry per entity that has every
+    indexed property, so a query reads one contiguous range of entries
+    instead of every entity of the kind. Entities with a list value for an
+    indexed property make the index unusable; queries then scan."""
+
+    def __init__(self, equality, orders):
+        self.equality = equality
+        self.orders = orders
+        self.names = equality + tuple(name for name, _ in orders)
+        self.entries = []
+        self.usable = True
+
+    def entry(self, pairs, values):
+        for name in self.names:
+            if name not in values:
+                return None
+            if isinstance(values[name], list):
+                self.usable = False
+                return None
+        return (tuple(_sort_value(values[name]) for name in self.equality),
+                self.order_values([values[name] for name, _ in self.orders]),
+                pairs)
+
+    def order_values(self, values):
+        return tuple(_Descending(_sort_value(value)) if descending
+                     else _sort_value(value)
+                     for value, (_, descending) in zip(values, self.orders))
+
+    def build(self, rows):
+        self.entries = sorted(entry for entry in
+                              (self.entry(pairs, values)
+                               for pairs, values in rows)
+                              if entry is not None)
+
+    def replace(self, pairs, old, new):
+        if old is not None:
+            entry = self.entry(pairs, old)
+            if entry is not None:
+                index = bisect.bisect_left(self.entries, entry)
+                if index < len(self.entries) and \
+                        self.entries[index] == entry:
+                    del self.entries[index]
+        if new is not None:
+            entry = self.entry(pairs, new)
+            if entry is not None:
+                bisect.insort(self.entries, entry)
+
+
+store = _Store()
+
+
+def _ledger(service, call, **sizes):
+    runtime.record(service, call, **sizes)
+
+
+# ---------------------------------------------------------------------------
+# Futures and tasklets
+
+
+class Return(StopIteration):
+    """Raised inside a tasklet to return a value."""
+
+
+class Future(object):
+    """A future resolved on creation: the stand-in has no event loop. It
+    remembers the round trip its RPCs finished on, and waiting for it moves
+    the caller's round-trip clock there, so RPCs started together cost the
+    depth of the longest rather than the sum."""
+
+    def __init__(self, result=None, exception=None, ready_at=None):
+        self._result = result
+        self._exception = exception
+        if ready_at is None:
+            ready_at = runtime.round_trips()
+        self._ready_at = ready_at
+
+    def done(self):
+        return True
+
+    def wait(self):
+        if self._ready_at > runtime.round_trips():
+            runtime.set_round_trips(self._ready_at)
+
+    def check_success(self):
+        self.wait()
+        if self._exception is not None:
+            raise self._exception
+
+    def get_result(self):
+        self.check_success()
+        return self._result
+
+    def get_exception(self):
+        self.wait()
+        return self._exception
+
+    @classmethod
+    def wait_all(cls, futures):
+        for future in futures:
+            future.wait()
+
+
+def _completed(fn, *args, **kwds):
+    """Runs fn now, as if it had run concurrently with the caller: the
+    caller's round-trip clock is left where it was until the future is
+    waited for."""
+    start = runtime.round_trips()
+    try:
+        future = Future(result=fn(*args, **kwds))
+    except Exception as e:
+        future = Future(exception=e)
+    runtime.set_round_trips(start)
+    return future
+
+
+def _spread(future, count):
+    """Splits the future of a batch operation into one per item."""
+    if future._exception is not None:
+        return [future] * count
+    return [Future(result=r, ready_at=future._ready_at)
+            for r in future._result]
+
+
+def _resolve(value):
+    if isinstance(value, Future):
+        return value.get_result()
+    if isinstance(value, (list, tuple)):
+        return type(value)(_resolve(v) for v in value)
+    return value
+
+
+def _run_tasklet(gen):
+    value, exc = None, None
+    while True:
+        try:
+            if exc is not None:
+                yielded = gen.throw(exc)
+            else:
+                yielded = gen.send(value)
+        except Return as r:
+            return r.args[0] if r.args else None
+        except StopIteration as s:
+            return s.args[0] if s.args else None
+        try:
+            value, exc = _resolve(yielded), None
+        except Exception as e:
+            value, exc = None, e
+
+
+def tasklet(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwds):
+        try:
+            result = func(*args, **kwds)
+        except Return as r:
+            return Future(result=r.args[0] if r.args else None)
+        except Exception as e:
+            return Future(exception=e)
+        if hasattr(result, 'send') and hasattr(result, 'throw'):
+            return _completed(_run_tasklet, result)
+        return Future(result=result)
+    return wrapper
+
+
+def synctasklet(func):
+    taskletfunc = tasklet(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwds):
+        return taskletfunc(*args, **kwds).get_result()
+    return wrapper
+
+
+def toplevel(func):
+    return synctasklet(func)
+
+
+# ---------------------------------------------------------------------------
+# Keys
+
+
+class Key(object):
+    """An immutable datastore key made of (kind, id) pairs."""
+
+    def __init__(self, *args, **kwds):
+        urlsafe = kwds.pop('urlsafe', None)
+        pairs = kwds.pop('pairs', None)
+        flat = kwds.pop('flat', None)
+        parent = kwds.pop('parent', None)
+        kwds.pop('namespace', None)
+        kwds.pop('app', None)
+        if kwds:
+            raise TypeError('Unexpected Key arguments %r' % kwds)
+        if urlsafe is not None:
+            pairs = _decode_urlsafe(urlsafe)
+        elif pairs is None:
+            if flat is None:
+                flat = args
+            if len(flat) == 1 and isinstance(flat[0], (list, tuple)):
+                flat = flat[0]
+            if len(flat) % 2:
+                raise BadArgumentError('Key requires (kind, id) pairs')
+            pairs = [(flat[i], flat[i + 1]) for i in range(0, len(flat), 2)]
+        normalized = []
+        for kind, id_ in pairs:
+            if isinstance(kind, type) and issubclass(kind, Model):
+                kind = kind._get_kind()
+            if isinstance(id_, unicode):
+                id_ = id_.encode('utf-8')
+            normalized.append((kind, id_))
+        if parent is not None:
+            normalized = list(parent.pairs()) + normalized
+        if not normalized:
+            raise BadArgumentError('Key must have at least one pair')
+        self.__pairs = tuple(normalized)
+
+    def pairs(self):
+        return self.__pairs
+
+    def flat(self):
+        return tuple(itertools.chain.from_iterable(self.__pairs))
+
+    def kind(self):
+        return self.__pairs[-1][0]
+
+    def id(self):
+        return self.__pairs[-1][1]
+
+    def string_id(self):
+        id_ = self.id()
+        return id_ if isinstance(id_, basestring) else None
+
+    def integer_id(self):
+        id_ = self.id()
+        return id_ if isinstance(id_, (int, long)) else None
+
+    def parent(self):
+        if len(self.__pairs) == 1:
+            return None
+        return Key(pairs=self.__pairs[:-1])
+
+    def root(self):
+        return Key(pairs=self.__pairs[:1])
+
+    def urlsafe(self):
+        raw = json.dumps([[k, i] for k, i in self.__pairs])
+        return base64.urlsafe_b64encode(raw).rstrip('=')
+
+    def get(self, **ctx_options):
+        return get_multi([self], **ctx_options)[0]
+
+    def get_async(self, **ctx_options):
+        return _completed(self.get, **ctx_options)
+
+    def delete(self, **ctx_options):
+        delete_multi([self], **ctx_options)
+
+    def delete_async(self, **ctx_options):
+        return _completed(self.delete, **ctx_options)
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self.__pairs == other.__pairs
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.__pairs < other.__pairs
+
+    def __hash__(self):
+        return hash(self.__pairs)
+
+    def __repr__(self):
+        return 'Key(%s)' % ', '.join(repr(x) for x in self.flat())
+
+
+class ProtocolBufferDecodeError(Exception):
+    """Raised for malformed urlsafe keys, as the SDK does."""
+
+
+def _decode_urlsafe(urlsafe):
+    if not isinstance(urlsafe, basestring):
+        raise TypeError('urlsafe must be a string')
+    try:
+        padded = str(urlsafe) + '=' * (-len(urlsafe) % 4)
+        pairs = json.loads(base64.urlsafe_b64decode(padded))
+        return [(str(k), str(i) if isinstance(i, unicode) else i)
+                for k, i in pairs]
+    except Exception:
+        raise ProtocolBufferDecodeError('Unable to decode key')
+
+
+# ---------------------------------------------------------------------------
+# Properties
+
+
+_MISSING = object()
+
+
+class FilterNode(object):
+
+    def __init__(self, name, op, value):
+        self.name, self.op, self.value = name, op, value
+
+    def matches(self, values):
+        if self.name not in values:
+            return False
+        stored = values[self.name]
+        candidates = stored if isinstance(stored, list) else [stored]
+        if self.op == 'in':
+            return any(c in self.value for c in candidates)
+        for c in candidates:
+            if self.op == '=':
+                if c == self.value:
+                    return True
+                continue
+            if c is None or self.value is None:
+                continue
+            if _type_rank(c) != _type_rank(self.value):
+                continue
+            if ((self.op == '<' and c < self.value) or
+                    (self.op == '<=' and c <= self.value) or
+                    (self.op == '>' and c > self.value) or
+                    (self.op == '>=' and c >= self.value) or
+                    (self.op == '!=' and c != self.value)):
+                return True
+        return False
+
+    def __repr__(self):
+        return 'FilterNode(%r, %r, %r)' % (self.name, self.op, self.value)
+
+
+class _Order(object):
+
+    def __init__(self, name, descending=False):
+        self.name, self.descending = name, descending
+
+
+class Property(object):
+    """Base property: stores python values, validates, and builds filters."""
+
+    _indexed_by_default = True
+
+    def __init__(self, name=None, indexed=None, repeated=False,
+                 required=False, default=None, choices=None, validator=None,
+                 verbose_name=None, kind=None):
+        self._name = name
+        self._code_name = None
+        self._indexed = (self._indexed_by_default
+                         if indexed is None else indexed)
+        self._repeated = repeated
+        self._required = required
+        self._default = default
+        self._choices = choices
+        self._validator = validator
+        self._kind = kind
+
+    def _fix_up(self, code_name):
+        self._code_name = code_name
+        if self._name is None:
+            self._name = code_name
+
+    def _validate(self, value):
+        return value
+
+    def _do_validate(self, value):
+        if value is None:
+            return None
+        value = self._validate(value)
+        if self._choices is not None and value not in self._choices:
+            raise BadValueError('Value %r for %s not in choices' %
+                                (value, self._name))
+        if self._validator is not None:
+            new = self._validator(self, value)
+            if new is not None:
+                value = new
+        return value
+
+    def __get__(self, entity, cls=None):
+        if entity is None:
+            return self
+        values = entity._values
+        if self._name not in values:
+            if entity._projection is not None:
+                raise runtime.UnprojectedPropertyError(self._name)
+            default = [] if self._repeated else self._default
+            values[self._name] = copy.copy(default)
+        return values[self._name]
+
+    def __set__(self, entity, value):
+        if self._repeated:
+            if value is None:
+                value = []
+            if not isinstance(value, (list, tuple)):
+                raise BadValueError('%s is repeated' % self._name)
+            value = [self._do_validate(v) for v in value]
+        else:
+            value = self._do_validate(value)
+        entity._values[self._name] = value
+
+    def _filter(self, op, value):
+        if not self._indexed:
+            raise BadQueryError('Cannot query unindexed property %s' %
+                                self._name)
+        if value is not None and op != 'in':
+            value = self._do_validate(value)
+        return FilterNode(self._name, op, value)
+
+    def __eq__(self, value):
+        return self._filter('=', value)
+
+    def __ne__(self, value):
+        return self._filter('!=', value)
+
+    def __lt__(self, value):
+        return self._filter('<', value)
+
+    def __le__(self, value):
+        return self._filter('<=', value)
+
+    def __gt__(self, value):
+        return self._filter('>', value)
+
+    def __ge__(self, value):
+        return self._filter('>=', value)
+
+    def IN(self, values):
+        return self._filter('in', [self._do_validate(v) for v in values])
+
+    def __neg__(self):
+        return _Order(self._name, descending=True)
+
+    def __pos__(self):
+        return _Order(self._name)
+
+    __hash__ = object.__hash__
+
+    def _prepare_for_put(self, entity):
+        pass
+
+    def _serialize(self, value):
+        return copy.deepcopy(value)
+
+
+class GenericProperty(Property):
+    pass
+
+
+class StringProperty(Property):
+
+    def _validate(self, value):
+        if not isinstance(value, basestring):
+            raise BadValueError('Expected string, got %r' % (value,))
+        if isinstance(value, str):
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                raise BadValueError('String is not valid utf-8')
+        if self._indexed and len(value.encode('utf-8')) > 1500:
+            raise BadValueError('Indexed string %s is too long' % self._name)
+        return value
+
+
+class TextProperty(StringProperty):
+    _indexed_by_default = False
+
+    def __init__(self, *args, **kwds):
+        super(TextProperty, self).__init__(*args, **kwds)
+        self._indexed = False
+
+
+class BlobProperty(Property):
+    _indexed_by_default = False
+
+    def _validate(self, value):
+        if not isinstance(value, str):
+            raise BadValueError('Expected str, got %r' % (value,))
+        return value
+
+
+class IntegerProperty(Property):
+
+    def _validate(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, long)):
+            raise BadValueError('Expected integer, got %r' % (value,))
+        return value
+
+
+class FloatProperty(Property):
+
+    def _validate(self, value):
+        if isinstance(value, bool) or not isinstance(value,
+                                                     (int, long, float)):
+            raise BadValueError('Expected float, got %r' % (value,))
+        return float(value)
+
+
+class BooleanProperty(Property):
+
+    def _validate(self, value):
+        if not isinstance(value, bool):
+            raise BadValueError('Expected bool, got %r' % (value,))
+        return value
+
+
+class DateTimeProperty(Property):
+    _type = datetime.datetime
+
+    def __init__(self, *args, **kwds):
+        self._auto_now = kwds.pop('auto_now', False)
+        self._auto_now_add = kwds.pop('auto_now_add', False)
+        super(DateTimeProperty, self).__init__(*args, **kwds)
+
+    def _validate(self, value):
+        if type(value) is not self._type:
+            raise BadValueError('Expected %s, got %r' %
+                                (self._type.__name__, value))
+        return value
+
+    def _now(self):
+        return runtime.now()
+
+    def _prepare_for_put(self, entity):
+        if (self._auto_now or
+                (self._auto_now_add and entity._values.get(self._name) is
+                 None)):
+            entity._values[self._name] = self._now()
+
+
+class DateProperty(DateTimeProperty):
+    _type = datetime.date
+
+    def _now(self):
+        return runtime.now().date()
+
+
+class KeyProperty(Property):
+
+    def __init__(self, *args, **kwds):
+        kind = kwds.pop('kind', None)
+        if args and not isinstance(args[0], basestring):
+            kind, args = args[0], args[1:]
+        if isinstance(kind, type) and issubclass(kind, Model):
+            kind = kind._get_kind()
+        super(KeyProperty, self).__init__(*args, **kwds)
+        self._kind = kind
+
+    def _validate(self, value):
+        if not isinstance(value, Key):
+            raise BadValueError('Expected Key, got %r' % (value,))
+        if self._kind is not None and value.kind() != self._kind:
+            raise BadValueError('Expected Key with kind %r, got %r' %
+                                (self._kind, value))
+        return value
+
+
+class JsonProperty(Property):
+    _indexed_by_default = False
+
+    def __init__(self, *args, **kwds):
+        kwds.pop('json_type', None)
+        super(JsonProperty, self).__init__(*args, **kwds)
+        self._indexed = False
+
+    def _validate(self, value):
+        json.dumps(value)
+        return value
+
+
+class PickleProperty(Property):
+    _indexed_by_default = False
+
+    def _validate(self, value):
+        pickle.dumps(value)
+        return value
+
+
+class ComputedProperty(Property):
+
+    def __init__(self, func, *args, **kwds):
+        super(ComputedProperty, self).__init__(*args, **kwds)
+        self._func = func
+
+    def __get__(self, entity, cls=None):
+        if entity is None:
+            return self
+        if entity._projection is not None and self._name in entity._values:
+            return entity._values[self._name]
+        return self._func(entity)
+
+    def __set__(self, entity, value):
+        raise runtime.ComputedPropertyError('Cannot assign %s' % self._name)
+
+    def _prepare_for_put(self, entity):
+        entity._values[self._name] = self._func(entity)
+
+
+# ---------------------------------------------------------------------------
+# Models
+
+
+_kind_map = {}
+
+
+class MetaModel(type):
+
+    def __init__(cls, name, bases, classdict):
+        super(MetaModel, cls).__init__(name, bases, classdict)
+        props = {}
+        for base in reversed(cls.__mro__[1:]):
+            props.update(getattr(base, '_properties', {}))
+        for attr, value in classdict.items():
+            if isinstance(value, Property):
+                value._fix_up(attr)
+                props[value._name] = value
+        cls._properties = props
+        if name != 'Model':
+            _kind_map[cls._get_kind()] = cls
+
+
+class Model(object):
+    """In-memory ndb.Model."""
+
+    __metaclass__ = MetaModel
+
+    _use_cache = True
+    _use_memcache = True
+
+    def __init__(self, **kwds):
+        key = kwds.pop('key', None)
+        id_ = kwds.pop('id', None)
+        parent = kwds.pop('parent', None)
+        kwds.pop('namespace', None)
+        projection = kwds.pop('projection', None)
+        self._values = {}
+        self._projection = projection
+        if key is not None:
+            self._key = key
+        elif id_ is not None or parent is not None:
+            self._key = Key(self._get_kind(), id_, parent=parent) \
+                if id_ is not None else _IncompleteKey(self._get_kind(),
+                                                       parent)
+        else:
+            self._key = None
+        self.populate(**kwds)
+
+    @classmethod
+    def _get_kind(cls):
+        return cls.__name__
+
+    def _get_key(self):
+        return self._key if isinstance(self._key, Key) else None
+
+    def _set_key(self, key):
+        self._key = key
+
+    key = property(_get_key, _set_key)
+
+    def populate(self, **kwds):
+        for name, value in kwds.items():
+            if not isinstance(getattr(type(self), name, None), Property):
+                raise TypeError('Unknown property %s' % name)
+            setattr(self, name, value)
+
+    def to_dict(self, include=None, exclude=None):
+        result = {}
+        for name, prop in self._properties.items():
+            if include and name not in include:
+                continue
+            if exclude and name in exclude:
+                continue
+            result[prop._code_name] = getattr(self, prop._code_name)
+        return result
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and self.key == other.key and
+                self._snapshot() == other._snapshot())
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = object.__hash__
+
+    def __repr__(self):
+        return '%s(key=%r, %s)' % (
+            type(self).__name__, self.key,
+            ', '.join('%s=%r' % kv for kv in sorted(self._values.items())))
+
+    # Persistence helpers.
+
+    def _snapshot(self):
+        values = {}
+        for name, prop in self._properties.items():
+            value = getattr(self, prop._code_name)
+            if prop._required and value is None:
+                raise BadValueError('Entity has uninitialized properties: '
+                                    '%s' % name)
+            values[name] = prop._serialize(value)
+        return values
+
+    def _pre_put_hook(self):
+        pass
+
+    def _post_put_hook(self, future):
+        pass
+
+    @classmethod
+    def _pre_get_hook(cls, key):
+        pass
+
+    @classmethod
+    def _post_get_hook(cls, key, future):
+        pass
+
+    @classmethod
+    def _pre_delete_hook(cls, key):
+        pass
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        pass
+
+    def put(self, **ctx_options):
+        return put_multi([self], **ctx_options)[0]
+
+    def put_async(self, **ctx_options):
+        return _completed(self.put, **ctx_options)
+
+    @classmethod
+    def get_by_id(cls, id_, parent=None, **ctx_options):
+        return Key(cls._get_kind(), id_, parent=parent).get(**ctx_options)
+
+    @classmethod
+    def get_by_id_async(cls, id_, parent=None, **ctx_options):
+        return _completed(cls.get_by_id, id_, parent=parent, **ctx_options)
+
+    @classmethod
+    def get_or_insert(cls, name, parent=None, **kwds):
+        key = Key(cls._get_kind(), name, parent=parent)
+
+        def txn():
+            entity = key.get()
+            if entity is None:
+                entity = cls(key=key, **kwds)
+                entity.put()
+            return entity
+        return transaction(txn, propagation=TransactionOptions.ALLOWED)
+
+    @classmethod
+    def get_or_insert_async(cls, name, parent=None, **kwds):
+        return _completed(cls.get_or_insert, name, parent=parent, **kwds)
+
+    @classmethod
+    def allocate_ids(cls, size=None, max=None, parent=None):
+        first = next(store.ids)
+        for _ in range(size - 1):
+            next(store.ids)
+        return first, first + size - 1
+
+    @classmethod
+    def query(cls, *filters, **kwds):
+        return Query(kind=cls._get_kind(), filters=list(filters), **kwds)
+
+
+class Expando(Model):
+    pass
+
+
+class _IncompleteKey(object):
+
+    def __init__(self, kind, parent):
+        self.kind, self.parent = kind, parent
+
+
+def _load(cls, key, values, projection=None):
+    entity = cls.__new__(cls)
+    entity._values = copy.deepcopy(values)
+    entity._projection = projection
+    entity._key = key
+    return entity
+
+
+# ---------------------------------------------------------------------------
+# Transactions
+
+
+class TransactionOptions(object):
+    NESTED = 1
+    MANDATORY = 2
+    ALLOWED = 3
+    INDEPENDENT = 4
+
+
+class _Transaction(object):
+
+    MAX_GROUPS = 25
+
+    def __init__(self, xg):
+        self.xg = xg
+        self.reads = {}
+        self.writes = {}
+        self.deletes = set()
+        self.groups = set()
+
+    def touch(self, pairs):
+        group = store.group_of(pairs)
+        if group not in self.groups:
+            self.groups.add(group)
+            limit = self.MAX_GROUPS if self.xg else 1
+            if len(self.groups) > limit:
+                raise BadRequestError(
+                    'operating on too many entity groups in a single '
+                    'transaction.')
+        if group not in self.reads:
+            self.reads[group] = store.group_versions.get(group, 0)
+
+
+_local = threading.local()
+
+
+def _current_txn():
+    return getattr(_local, 'txn', None)
+
+
+def in_transaction():
+    return _current_txn() is not None
+
+
+def transaction(callback, **options):
+    propagation = options.get('propagation') or TransactionOptions.NESTED
+    retries = options.get('retries', 3)
+    xg = options.get('xg', False)
+    current = _current_txn()
+    if current is not None:
+        if propagation == TransactionOptions.NESTED:
+            raise BadRequestError('Nested transactions are not supported.')
+        if propagation in (TransactionOptions.ALLOWED,
+                           TransactionOptions.MANDATORY):
+            if xg and not current.xg:
+                raise BadRequestError('Cannot change xg inside transaction')
+            return callback()
+    elif propagation == TransactionOptions.MANDATORY:
+        raise BadRequestError('Requires an existing transaction')
+    for attempt in range(retries + 1):
+        txn = _Transaction(xg)
+        _local.txn, saved = txn, current
+        _ledger('datastore_v3', 'BeginTransaction')
+        try:
+            try:
+                result = callback()
+                if isinstance(result, Future):
+                    result = result.get_result()
+            except Rollback:
+                _ledger('datastore_v3', 'Rollback')
+                return None
+            except Exception:
+                _ledger('datastore_v3', 'Rollback')
+                raise
+        finally:
+            _local.txn = saved
+        runtime.maybe_interleave(txn)
+        _ledger('datastore_v3', 'Commit')
+        with store.lock:
+            conflict = any(store.group_versions.get(g, 0) != v
+                           for g, v in txn.reads.items())
+            if not conflict:
+                _apply_writes(txn.writes, txn.deletes)
+                runtime.count('txn_commits')
+                return result
+        runtime.count('txn_conflicts')
+    raise TransactionFailedError(
+        'The transaction could not be committed. Please try again.')
+
+
+def transaction_async(callback, **options):
+    return _completed(transaction, callback, **options)
+
+
+def transactional(func=None, **options):
+    if func is None:
+        return lambda f: transactional(f, **options)
+    options.setdefault('propagation', TransactionOptions.ALLOWED)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwds):
+        return transaction(lambda: func(*args, **kwds), **options)
+    return wrapper
+
+
+def transactional_tasklet(func=None, **options):
+    if func is None:
+        return lambda f: transactional_tasklet(f, **options)
+    inner = transactional(synctasklet(func), **options)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwds):
+        return _completed(inner, *args, **kwds)
+    return wrapper
+
+
+def non_transactional(func=None, allow_existing=True):
+    if func is None:
+        return lambda f: non_transactional(f, allow_existing)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwds):
+        saved = _current_txn()
+        _local.txn = None
+        try:
+            return func(*args, **kwds)
+        finally:
+            _local.txn = saved
+    return wrapper
+
+
+def _apply_writes(writes, deletes):
+    for pairs, record in writes.items():
+        store.write(pairs, record)
+    for pairs in deletes:
+        store.write(pairs, None)
+
+
+# ---------------------------------------------------------------------------
+# Batch operations
+
+
+def _complete_key(entity):
+    key = entity._key
+    if isinstance(key, Key):
+        return key
+    parent = key.parent if isinstance(key, _IncompleteKey) else None
+    key = Key(entity._get_kind(), next(store.ids), parent=parent)
+    entity._key = key
+    return key
+
+
+def put_multi(entities, **ctx_options):
+    entities = list(entities)
+    if not entities:
+        return []
+    for entity in entities:
+        if entity._projection is not None:
+            raise BadRequestError('Cannot put a partial entity')
+        entity._pre_put_hook()
+        for prop in entity._properties.values():
+            prop._prepare_for_put(entity)
+    snapshots = [(e._get_kind(), e._snapshot()) for e in entities]
+    keys = [_complete_key(e) for e in entities]
+    txn = _current_txn()
+    _ledger('datastore_v3', 'Put', entities=len(entities))
+    if txn is not None:
+        for key, snap in zip(keys, snapshots):
+            txn.touch(key.pairs())
+            txn.writes[key.pairs()] = snap
+            txn.deletes.discard(key.pairs())
+    else:
+        with store.lock:
+            _apply_writes(dict((k.pairs(), s)
+                               for k, s in zip(keys, snapshots)), ())
+    for entity in entities:
+        entity._post_put_hook(Future(result=entity.key))
+    return keys
+
+
+def put_multi_async(entities, **ctx_options):
+    entities = list(entities)
+    return _spread(_completed(put_multi, entities, **ctx_options),
+                   len(entities))
+
+
+def get_multi(keys, **ctx_options):
+    keys = list(keys)
+    if not keys:
+        return []
+    txn = _current_txn()
+    _ledger('datastore_v3', 'Get', keys=len(keys))
+    results = []
+    for key in keys:
+        cls = _kind_map.get(key.kind())
+        if cls is not None:
+            cls._pre_get_hook(key)
+        pairs = key.pairs()
+        if txn is not None:
+            txn.touch(pairs)
+            if pairs in txn.deletes:
+                results.append(None)
+                continue
+            record = txn.writes.get(pairs) or store.entities.get(pairs)
+        else:
+            record = store.entities.get(pairs)
+        if record is None:
+            entity = None
+        else:
+            kind, values = record
+            entity = _load(_kind_map[kind], key, values)
+        if cls is not None:
+            cls._post_get_hook(key, Future(result=entity))
+        results.append(entity)
+    return results
+
+
+def get_multi_async(keys, **ctx_options):
+    keys = list(keys)
+    return _spread(_completed(get_multi, keys, **ctx_options), len(keys))
+
+
+def delete_multi(keys, **ctx_options):
+    keys = list(keys)
+    if not keys:
+        return []
+    _ledger('datastore_v3', 'Delete', keys=len(keys))
+    txn = _current_txn()
+    for key in keys:
+        cls = _kind_map.get(key.kind())
+        if cls is not None:
+            cls._pre_delete_hook(key)
+    if txn is not None:
+        for key in keys:
+            txn.touch(key.pairs())
+            txn.writes.pop(key.pairs(), None)
+            txn.deletes.add(key.pairs())
+    else:
+        with store.lock:
+            _apply_writes({}, [k.pairs() for k in keys])
+    for key in keys:
+        cls = _kind_map.get(key.kind())
+        if cls is not None:
+            cls._post_delete_hook(key, Future())
+    return [None] * len(keys)
+
+
+def delete_multi_async(keys, **ctx_options):
+    keys = list(keys)
+    return _spread(_completed(delete_multi, keys, **ctx_options), len(keys))
+
+
+def get_context():
+    context = getattr(_local, 'context', None)
+    if context is None:
+        context = _local.context = _Context()
+    return context
+
+
+class _Context(object):
+    """The thread's context. Its memcache methods return futures, and
+    share one compare-and-set client."""
+
+    def __init__(self):
+        from bench.fakes import memcache
+        self._memcache = memcache.Client()
+
+    def memcache_get(self, key, for_cas=False, namespace=None,
+                     use_cache=False, deadline=None):
+        fn = self._memcache.gets if for_cas else self._memcache.get
+        return _completed(fn, key, namespace=namespace)
+
+    def memcache_gets(self, key, namespace=None, use_cache=False,
+                      deadline=None):
+        return self.memcache_get(key, for_cas=True, namespace=namespace)
+
+    def memcache_set(self, key, value, time=0, namespace=None,
+                     use_cache=False, deadline=None):
+        return _completed(self._memcache.set, key, value, time=time,
+                          namespace=namespace)
+
+    def memcache_add(self, key, value, time=0, namespace=None,
+                     deadline=None):
+        return _completed(self._memcache.add, key, value, time=time,
+                          namespace=namespace)
+
+    def memcache_replace(self, key, value, time=0, namespace=None,
+                         deadline=None):
+        return _completed(self._memcache.replace, key, value, time=time,
+                          namespace=namespace)
+
+    def memcache_cas(self, key, value, time=0, namespace=None,
+                     deadline=None):
+        return _completed(self._memcache.cas, key, value, time=time,
+                          namespace=namespace)
+
+    def memcache_delete(self, key, seconds=0, namespace=None,
+                        deadline=None):
+        return _completed(self._memcache.delete, key, seconds=seconds,
+                          namespace=namespace)
+
+    def memcache_incr(self, key, delta=1, initial_value=None,
+                      namespace=None, deadline=None):
+        return _completed(self._memcache.incr, key, delta=delta,
+                          initial_value=initial_value, namespace=namespace)
+
+    def memcache_decr(self, key, delta=1, initial_value=None,
+                      namespace=None, deadline=None):
+        return _completed(self._memcache.decr, key, delta=delta,
+                          initial_value=initial_value, namespace=namespace)
+
+    def set_cache_policy(self, policy):
+        pass
+
+    def set_memcache_policy(self, policy):
+        pass
+
+    def clear_cache(self):
+        pass
+
+
+# ---------------------------------------------------------------------------
+# Queries
+
+
+_TYPE_RANKS = [
+    (type(None), 0), (bool, 2), ((int, long), 1),
+    ((datetime.datetime, datetime.date), 1), (basestring, 3),
+    (float, 4), (Key, 5)]
+
+
+def _type_rank(value):
+    for types, rank in _TYPE_RANKS:
+        if isinstance(value, types):
+            return rank
+    return 9
+
+
+def _sort_value(value):
+    if isinstance(value, datetime.datetime):
+        return (1, 1, value)
+    if isinstance(value, datetime.date):
+        return (1, 1, datetime.datetime.combine(value, datetime.time()))
+    if isinstance(value, Key):
+        return (5, 0, value.pairs())
+    return (_type_rank(value), 0, value)
+
+
+class Cursor(object):
+    """Opaque position in a query's result order."""
+
+    def __init__(self, urlsafe=None, position=None):
+        if urlsafe is not None:
+            try:
+                padded = str(urlsafe) + '=' * (-len(urlsafe) % 4)
+                position = pickle.loads(base64.urlsafe_b64decode(padded))
+            except Exception:
+                raise BadValueError('Invalid cursor')
+        self.position = position
+
+    def urlsafe(self):
+        return base64.urlsafe_b64encode(
+            pickle.dumps(self.position, 2)).rstrip('=')
+
+    to_websafe_string = urlsafe
+
+    def __eq__(self, other):
+        return isinstance(other, Cursor) and self.position == other.position
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class QueryIterator(object):
+
+    def __init__(self, results, positions):
+        self._results = results
+        self._positions = positions
+        self._index = 0
+
+    def __iter__(self):
+        return self
+
+    def has_next(self):
+        return self._index < len(self._results)
+
+    def next(self):
+        if not self.has_next():
+            raise StopIteration
+        self._index += 1
+        return self._results[self._index - 1]
+
+    __next__ = next
+
+    def cursor_before(self):
+        if self._index == 0:
+            raise BadArgumentError('There is no cursor before the start')
+        return Cursor(position=self._before(self._index - 1))
+
+    def cursor_after(self):
+        if self._index == 0:
+            raise BadArgumentError('There is no cursor yet')
+        return Cursor(position=self._positions[self._index - 1])
+
+    def _before(self, index):
+        return self._positions[index - 1] if index > 0 else ()
+
+
+class Query(object):
+    """Immutable query over one kind."""
+
+    def __init__(self, kind=None, filters=None, orders=None, ancestor=None,
+                 projection=None, keys_only=False, distinct=False,
+                 default_options=None, group_by=None):
+        self.kind = kind
+        self.filters = list(filters or [])
+        self.orders = list(orders or [])
+        self.ancestor = ancestor
+        self.projection = projection
+        self.keys_only = keys_only
+        self.distinct = distinct
+
+    def _clone(self, **changes):
+        q = copy.copy(self)
+        q.filters = list(self.filters)
+        q.orders = list(self.orders)
+        for name, value in changes.items():
+            setattr(q, name, value)
+        return q
+
+    def filter(self, *nodes):
+        return self._clone(filters=self.filters + list(nodes))
+
+    def order(self, *orders):
+        new = []
+        for o in orders:
+            if isinstance(o, Property):
+                o = _Order(o._name)
+            new.append(o)
+        return self._clone(orders=self.orders + new)
+
+    # Execution.
+
+    def _names(self, projection):
+        if not projection:
+            return None
+        return [p._name if isinstance(p, Property) else p
+                for p in projection]
+
+    def _run(self, keys_only=None, projection=None, start_cursor=None,
+             end_cursor=None, offset=0, limit=None, count_only=False):
+        keys_only = self.keys_only if keys_only is None else keys_only
+        projection = self._names(projection or self.projection)
+        txn = _current_txn()
+        if txn is not None:
+            if self.ancestor is None:
+                raise BadRequestError('Only ancestor queries are allowed '
+                                      'inside transactions.')
+            txn.touch(self.ancestor.pairs())
+        runtime.check_index(self, projection)
+
+        def position(row):
+            key, values = row
+            return tuple(_sort_value(values[o.name]) for o in self.orders) + \
+                (key.pairs(),)
+
+        def compare(a, b):
+            for i, o in enumerate(self.orders):
+                c = cmp(a[i], b[i])
+                if c:
+                    return -c if o.descending else c
+            return cmp(a[-1], b[-1])
+
+        def wanted(values):
+            return (all(node.matches(values) for node in self.filters) and
+                    all(o.name in values and
+                        not isinstance(values[o.name], list)
+                        for o in self.orders) and
+                    all(p in values and values[p] is not None
+                        for p in projection or ()))
+
+        stop = None
+        if limit is not None and not count_only:
+            stop = offset + limit + 1
+        with store.lock:
+            rows = self._index_scan(wanted, start_cursor, end_cursor, stop)
+            if rows is None:
+                rows = [(Key(pairs=pairs), values)
+                        for pairs, (kind, values) in store.entities.items()
+                        if kind == self.kind and wanted(values)]
+                scanned = True
+            else:
+                scanned = False
+        if scanned:
+            if self.ancestor is not None:
+                anc = self.ancestor.pairs()
+                rows = [r for r in rows if r[0].pairs()[:len(anc)] == anc]
+            rows = [(position(r), r) for r in rows]
+            rows.sort(key=functools.cmp_to_key(
+                lambda x, y: compare(x[0], y[0])))
+            if start_cursor is not None and start_cursor.position:
+                pos = start_cursor.position
+                rows = [r for r in rows if compare(r[0], pos) > 0]
+            if end_cursor is not None and end_cursor.position:
+                pos = end_cursor.position
+                rows = [r for r in rows if compare(r[0], pos) <= 0]
+        else:
+            rows = [(position(r), r) for r in rows]
+        if count_only:
+            _ledger('datastore_v3', 'RunQuery', keys_only=True)
+            rows = rows[offset:]
+            return rows[:limit] if limit is not None else rows
+        rows = rows[offset:]
+        more = limit is not None and len(rows) > limit
+        if limit is not None:
+            rows = rows[:limit]
+        batch_size = len(rows) if keys_only else 20
+        _ledger('datastore_v3', 'RunQuery',
+                results=min(len(rows), batch_size), keys_only=keys_only,
+                projection=bool(projection))
+        for start in range(batch_size, len(rows), batch_size or 1):
+            _ledger('datastore_v3', 'Next',
+                    results=min(len(rows) - start, batch_size))
+        cls = _kind_map[self.kind]
+        results = []
+        positions = []
+        for pos, (key, values) in rows:
+            positions.append(pos)
+            if keys_only:
+                results.append(key)
+            elif projection:
+                results.append(_load(cls, key,
+                                     dict((p, values[p]) for p in projection),
+                                     projection=projection))
+            else:
+                results.append(_load(cls, key, values))
+        return results, positions, more
+
+    def _index_scan(self, wanted, start_cursor, end_cursor, stop):
+        """Reads the matching (key, values) rows, in query order, from the
+        range of a sorted index, stopping after stop rows. Returns None when
+        the query has no usable index and must scan the kind instead."""
+        if self.ancestor is not None:
+            return None
+        equality = {}
+        inequality = False
+        for node in self.filters:
+            if node.op == '=' and not isinstance(node.value, list) and \
+                    node.name not in equality:
+                equality[node.name] = node.value
+            elif node.op in ('<', '<=', '>', '>=') and not inequality:
+                inequality = True
+            else:
+                return None
+        orders = tuple((o.name, o.descending) for o in self.orders
+                       if o.name not in equality)
+        if inequality and not orders:
+            # The datastore would sort by the inequality property first,
+            # which this stand-in's cursors do not model.
+            return None
+        names = tuple(sorted(equality))
+        index = store.index(self.kind, names, orders)
+        if not index.usable:
+            return None
+        prefix = tuple(_sort_value(equality[name]) for name in names)
+        entries = index.entries
+        lo = bisect.bisect_left(entries, (prefix,))
+        hi = bisect.bisect_left(entries, (prefix, _LAST))
+
+        def probe(position):
+            values = [value for value, o in zip(position, self.orders)
+                      if o.name not in equality]
+            return (prefix, tuple(_Descending(v) if o[1] else v
+                                  for v, o in zip(values, orders)),
+                    position[-1])
+        if start_cursor is not None and start_cursor.position:
+            lo = max(lo, bisect.bisect_right(entries,
+                                             probe(start_cursor.position)))
+        if end_cursor is not None and end_cursor.position:
+            hi = min(hi, bisect.bisect_right(entries,
+                                             probe(end_cursor.position)))
+        rows = []
+        for i in xrange(lo, hi):
+            pairs = entries[i][2]
+            values = store.entities[pairs][1]
+            if wanted(values):
+                rows.append((Key(pairs=pairs), values))
+                if stop is not None and len(rows) >= stop:
+                    break
+        return rows
+
+    def fetch(self, limit=None, **options):
+        results, _, _ = self._run(
+            keys_only=options.get('keys_only'),
+            projection=options.get('projection'),
+            start_cursor=options.get('start_cursor'),
+            end_cursor=options.get('end_cursor'),
+            offset=options.get('offset', 0), limit=limit)
+        return results
+
+    def fetch_async(self, limit=None, **options):
+        return _completed(self.fetch, limit, **options)
+
+    def fetch_page(self, page_size, **options):
+        results, positions, more = self._run(
+            keys_only=options.get('keys_only'),
+            projection=options.get('projection'),
+            start_cursor=options.get('start_cursor'),
+            end_cursor=options.get('end_cursor'),
+            offset=options.get('offset', 0), limit=page_size)
+        cursor = Cursor(position=positions[-1]) if positions else None
+        return results, cursor, more
+
+    def fetch_page_async(self, page_size, **options):
+        return _completed(self.fetch_page, page_size, **options)
+
+    def get(self, **options):
+        results = self.fetch(1, **options)
+        return results[0] if results else None
+
+    def get_async(self, **options):
+        return _completed(self.get, **options)
+
+    def count(self, limit=None, **options):
+        return len(self._run(start_cursor=options.get('start_cursor'),
+                             end_cursor=options.get('end_cursor'),
+                             offset=options.get('offset', 0), limit=limit,
+                             count_only=True))
+
+    def count_async(self, limit=None, **options):
+        return _completed(self.count, limit, **options)
+
+    def iter(self, **options):
+        results, positions, _ = self._run(
+            keys_only=options.get('keys_only'),
+            projection=options.get('projection'),
+            start_cursor=options.get('start_cursor'),
+            end_cursor=options.get('end_cursor'),
+            offset=options.get('offset', 0), limit=options.get('limit'))
+        return QueryIterator(results, positions)
+
+    def __iter__(self):
+        return self.iter()
+
+    def map(self, callback, **options):
+        return [callback(e) for e in self.iter(**options)]
+
+    def map_async(self, callback, **options):
+        return _completed(self.map, callback, **options)
+
+
+def AND(*nodes):
+    raise BadQueryError('AND nodes are not supported by the stand-in; pass '
+                        'filters positionally')
+
+
+def OR(*nodes):
+    raise BadQueryError('OR queries are not supported by the stand-in')
@@ -0,0 +1,22 @@
+"""oauth.py - Stand-in for google.appengine.api.oauth."""
+
+from bench.fakes import users
+
+
+class Error(Exception):
+    pass
+
+
+class OAuthRequestError(Error):
+    pass
+
+
+def get_current_user(scope=None):
+    user = users.get_current_user()
+    if user is None:
+        raise OAuthRequestError('No current user')
+    return user
+
+
+def is_current_user_admin(scope=None):
+    return users.state['admin']
@@ -0,0 +1,9 @@
+"""remote.py - Stand-in for protorpc.remote.
+
+The real module needs the SDK's protocol buffer runtime; endpoint services
+only use it for the Service base class.
+"""
+
+
+class Service(object):
+    """Base class for endpoint services."""
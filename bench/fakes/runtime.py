@@ -0,0 +1,206 @@
+"""runtime.py - Shared state for the in-memory App Engine stand-ins.
+
+Holds the RPC ledger every stand-in charges its calls to (and which reports
+each call to the apiproxy hooks), the round-trip clock that measures how
+many RPCs deep a call's critical path is, the clock the
+datastore and memcache read, the composite-index checker that mirrors the
+production datastore's NeedIndexError, and a hook that lets benchmarks
+interleave a competing write between a transaction's reads and its commit.
+"""
+
+import collections
+import datetime
+import os
+import threading
+
+from bench.fakes.datastore_errors import BadRequestError, NeedIndexError
+
+
+class UnprojectedPropertyError(Exception):
+    """Raised when reading a property that a projection query left out."""
+
+
+class ComputedPropertyError(Exception):
+    """Raised when assigning to a ComputedProperty."""
+
+
+_lock = threading.Lock()
+rpcs = collections.Counter()
+counters = collections.Counter()
+_clock = {'offset': datetime.timedelta(0)}
+_interleave = []
+_indexes = {'loaded': None, 'strict': True}
+_trips = threading.local()
+
+
+def record(service, call, **sizes):
+    """Charges one RPC to the ledger and runs the apiproxy hooks for it.
+    sizes are what the RPC carried: keys, entities, results or hits."""
+    from bench.fakes import apiproxy_stub_map
+    with _lock:
+        rpcs['%s.%s' % (service, call)] += 1
+    _trips.now = round_trips() + 1
+    apiproxy_stub_map.make_call(service, call, sizes)
+
+
+def round_trips():
+    """The calling thread's round-trip clock. Every RPC advances it by one;
+    RPCs started together through futures advance it once, to the latest
+    of them, when their results are waited for."""
+    return getattr(_trips, 'now', 0)
+
+
+def set_round_trips(value):
+    _trips.now = value
+
+
+def count(name, delta=1):
+    with _lock:
+        counters[name] += delta
+
+
+def snapshot():
+    with _lock:
+        return collections.Counter(rpcs)
+
+
+def reset_ledger():
+    with _lock:
+        rpcs.clear()
+        counters.clear()
+
+
+def datastore_rpcs(ledger):
+    return sum(v for k, v in ledger.items() if k.startswith('datastore_v3.'))
+
+
+def now():
+    return datetime.datetime.utcnow() + _clock['offset']
+
+
+def advance(**delta):
+    _clock['offset'] += datetime.timedelta(**delta)
+
+
+def reset_clock():
+    _clock['offset'] = datetime.timedelta(0)
+
+
+def interleave(callback):
+    """Runs callback(txn) once, just before the next transaction commits."""
+    _interleave.append(callback)
+
+
+def maybe_interleave(txn):
+    while _interleave:
+        callback = _interleave.pop(0)
+        from bench.fakes import ndb
+        saved = ndb._local.txn
+        ndb._local.txn = None
+        try:
+            callback(txn)
+        finally:
+            ndb._local.txn = saved
+
+
+# ---------------------------------------------------------------------------
+# Composite index checks
+
+
+def load_indexes(app_dir, strict=True):
+    """Reads index.yaml so queries needing an undeclared index fail."""
+    indexes = []
+    path = os.path.join(app_dir, 'index.yaml')
+    current = None
+    if os.path.exists(path):
+        with open(path) as f:
+            for raw in f:
+                line = raw.split('#', 1)[0].rstrip()
+                stripped = line.strip()
+                if stripped.startswith('- kind:'):
+                    current = {'kind': stripped.split(':', 1)[1].strip(),
+                               'ancestor': False, 'properties': []}
+                    indexes.append(current)
+                elif current is None:
+                    continue
+                elif stripped.startswith('ancestor:'):
+                    current['ancestor'] = \
+                        stripped.split(':', 1)[1].strip() == 'yes'
+                elif stripped.startswith('- name:'):
+                    current['properties'].append(
+                        [stripped.split(':', 1)[1].strip(), False])
+                elif stripped.startswith('direction:'):
+                    current['properties'][-1][1] = \
+                        stripped.split(':', 1)[1].strip() == 'desc'
+    _indexes['loaded'] = indexes
+    _indexes['strict'] = strict
+
+
+def check_index(query, projection):
+    indexes = _indexes['loaded']
+    if indexes is None:
+        return
+    equality = set()
+    inequality = set()
+    for node in query.filters:
+        if node.op in ('=', 'in'):
+            equality.add(node.name)
+        else:
+            inequality.add(node.name)
+    if len(inequality) > 1:
+        raise BadRequestError('Only one inequality filter per query is '
+                              'supported: %s' % sorted(inequality))
+    orders = [(o.name, o.descending) for o in query.orders
+              if o.name not in equality]
+    if inequality and orders and orders[0][0] not in inequality:
+        raise BadRequestError('The first sort property must be the same as '
+                              'the property to which the inequality filter '
+                              'is applied.')
+    projection = list(projection or [])
+    if equality & set(projection):
+        raise BadRequestError('Cannot use projection on a property with an '
+                              'equality filter.')
+    postfix = []
+    for name in inequality:
+        if not orders:
+            postfix.append((name, False))
+    postfix.extend(orders)
+    names = equality | inequality | set(n for n, _ in orders) | \
+        set(projection)
+    ancestor = query.ancestor is not None
+    if not postfix and not projection:
+        return
+    if len(names) <= 1 and not ancestor:
+        return
+    for index in indexes:
+        if index['kind'] != query.kind or index['ancestor'] != ancestor:
+            continue
+        props = [(n, d) for n, d in index['properties']]
+        head = props[:len(equality)]
+        if set(n for n, _ in head) != equality:
+            continue
+        tail = props[len(equality):]
+        if tail[:len(postfix)] != postfix:
+            continue
+        rest = set(n for n, _ in tail[len(postfix):]) | \
+            set(n for n, _ in postfix)
+        if set(projection) <= rest:
+            return
+    suggestion = ['- kind: %s' % query.kind]
+    if ancestor:
+        suggestion.append('  ancestor: yes')
+    suggestion.append('  properties:')
+    seen = set()
+    for name, desc in ([(n, False) for n in sorted(equality)] + postfix +
+                       [(n, False) for n in projection]):
+        if name in seen:
+            continue
+        seen.add(name)
+        suggestion.append('  - name: %s' % name)
+        if desc:
+            suggestion.append('    direction: desc')
+    message = 'no matching index found. Suggested index:\n' + \
+        '\n'.join(suggestion)
+    if _indexes['strict']:
+        raise NeedIndexError(message)
+    count('missing_indexes')
@@ -0,0 +1,112 @@
+"""taskqueue.py - In-memory stand-in for google.appengine.api.taskqueue.
+
+Tasks are recorded, not executed; bench.harness.run_tasks() drains them
+through the webapp2 stand-in. Named tasks leave tombstones, like production.
+"""
+
+import itertools
+import threading
+
+from bench.fakes import runtime
+
+
+class Error(Exception):
+    pass
+
+
+class TaskAlreadyExistsError(Error):
+    pass
+
+
+class TombstonedTaskError(Error):
+    pass
+
+
+class DuplicateTaskNameError(Error):
+    pass
+
+
+class TransientError(Error):
+    pass
+
+
+_lock = threading.Lock()
+_queues = {}
+_names = set()
+_ids = itertools.count(1)
+
+
+def reset():
+    with _lock:
+        _queues.clear()
+        _names.clear()
+
+
+class Task(object):
+
+    def __init__(self, payload=None, url=None, params=None, name=None,
+                 countdown=None, eta=None, method='POST', headers=None,
+                 target=None, retry_options=None):
+        self.payload = payload
+        self.url = url
+        self.params = dict(params or {})
+        self.name = name or 'task%d' % next(_ids)
+        self.countdown = countdown
+        self.eta = eta
+        self.method = method
+        self.headers = dict(headers or {})
+        self._named = name is not None
+
+    def add(self, queue_name='default', transactional=False):
+        return Queue(queue_name).add(self)
+
+    def __repr__(self):
+        return 'Task(%r, %r)' % (self.name, self.url)
+
+
+class Queue(object):
+
+    def __init__(self, name='default'):
+        self.name = name
+
+    def add(self, task, transactional=False):
+        tasks = task if isinstance(task, (list, tuple)) else [task]
+        runtime.record('taskqueue', 'BulkAdd', tasks=len(tasks))
+        with _lock:
+            batch = set()
+            for t in tasks:
+                if t._named:
+                    if t.name in batch:
+                        raise DuplicateTaskNameError(t.name)
+                    if t.name in _names:
+                        raise TaskAlreadyExistsError(t.name)
+                    batch.add(t.name)
+            for t in tasks:
+                if t._named:
+                    _names.add(t.name)
+                _queues.setdefault(self.name, []).append(t)
+        return task
+
+    def add_async(self, task, transactional=False):
+        from bench.fakes import ndb
+        return ndb._completed(self.add, task)
+
+
+def add(*args, **kwds):
+    queue_name = kwds.pop('queue_name', 'default')
+    transactional = kwds.pop('transactional', False)
+    return Task(*args, **kwds).add(queue_name, transactional=transactional)
+
+
+def pending(queue_name=None):
+    with _lock:
+        if queue_name is not None:
+            return list(_queues.get(queue_name, []))
+        return [t for q in _queues.values() for t in q]
+
+
+def pop_all():
+    with _lock:
+        tasks = [t for q in _queues.values() for t in q]
+        _queues.clear()
+        return tasks
@@ -0,0 +1,25 @@
+"""users.py - Stand-in for google.appengine.api.users."""
+
+state = {'admin': False, 'email': None}
+
+
+class User(object):
+
+    def __init__(self, email=None):
+        self._email = email
+
+    def email(self):
+        return self._email
+
+    def nickname(self):
+        return (self._email or '').split('@')[0]
+
+
+def get_current_user():
+    if state['email'] is None:
+        return None
+    return User(state['email'])
+
+
+def is_current_user_admin():
+    return state['admin']
@@ -0,0 +1,72 @@
+"""webapp2.py - Minimal stand-in for webapp2 request dispatch."""
+
+import re
+
+
+class Request(object):
+
+    def __init__(self, path, params=None, body='', headers=None):
+        self.path = path
+        self.params = dict(params or {})
+        self.body = body
+        self.headers = dict(headers or {})
+
+    def get(self, name, default_value=''):
+        return self.params.get(name, default_value)
+
+    def get_all(self, name):
+        value = self.params.get(name)
+        if value is None:
+            return []
+        return value if isinstance(value, list) else [value]
+
+
+class Response(object):
+
+    def __init__(self):
+        self.status_int = 200
+        self.body = []
+        self.headers = {}
+        self.out = self
+
+    def set_status(self, code, message=None):
+        self.status_int = code
+
+    def write(self, text):
+        self.body.append(text)
+
+
+class RequestHandler(object):
+
+    def __init__(self, request=None, response=None):
+        self.request = request
+        self.response = response
+
+    def abort(self, code, *args, **kwds):
+        raise HTTPException(code)
+
+    def error(self, code):
+        self.response.set_status(code)
+
+
+class HTTPException(Exception):
+
+    def __init__(self, code):
+        super(HTTPException, self).__init__(code)
+        self.code = code
+
+
+class WSGIApplication(object):
+
+    def __init__(self, routes=None, debug=False, config=None):
+        self.routes = [(re.compile('^%s$' % pattern), handler)
+                       for pattern, handler in (routes or [])]
+
+    def dispatch(self, method, path, params=None, body='', headers=None):
+        for pattern, handler in self.routes:
+            if pattern.match(path):
+                request = Request(path, params, body, headers)
+                response = Response()
+                getattr(handler(request, response), method.lower())()
+                return response
+        raise LookupError('No route for %s' % path)
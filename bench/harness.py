@@ -0,0 +1,134 @@
+"""harness.py - Load the game against in-memory App Engine stand-ins.
+
+install() registers the stand-ins under the module names the app imports
+(google.appengine.ext.ndb, google.appengine.api.memcache, endpoints, ...)
+and puts the application directory on sys.path, so api.py, main.py and
+models.py import unchanged. Requires protorpc (pip install protorpc).
+"""
+
+import os
+import sys
+import types
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_installed = {}
+
+
+def _package(name):
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(name)
+        module.__path__ = []
+        sys.modules[name] = module
+    if '.' in name:
+        parent, child = name.rsplit('.', 1)
+        setattr(_package(parent), child, module)
+    return module
+
+
+def _alias(name, module):
+    sys.modules[name] = module
+    parent, child = name.rsplit('.', 1)
+    setattr(_package(parent), child, module)
+
+
+def install(app_dir=APP_DIR, strict_indexes=True):
+    """Registers the stand-ins and makes the app importable."""
+    if _installed:
+        return _installed['app_dir']
+    import protorpc
+    from bench.fakes import remote
+    sys.modules['protorpc.remote'] = remote
+    protorpc.remote = remote
+
+    from bench.fakes import (apiproxy_stub_map, app_identity,
+                             datastore_errors, endpoints, mail, memcache, ndb,
+                             oauth, runtime, taskqueue, users, webapp2)
+    _alias('google.appengine.ext.ndb', ndb)
+    _alias('google.appengine.api.datastore_errors', datastore_errors)
+    _alias('google.appengine.api.memcache', memcache)
+    _alias('google.appengine.api.taskqueue', taskqueue)
+    _alias('google.appengine.api.mail', mail)
+    _alias('google.appengine.api.app_identity', app_identity)
+    _alias('google.appengine.api.users', users)
+    _alias('google.appengine.api.oauth', oauth)
+    _alias('google.appengine.api.apiproxy_stub_map', apiproxy_stub_map)
+    query = types.ModuleType('google.appengine.datastore.datastore_query')
+    query.Cursor = ndb.Cursor
+    _alias('google.appengine.datastore.datastore_query', query)
+    sys.modules['endpoints'] = endpoints
+    sys.modules['webapp2'] = webapp2
+
+    runtime.load_indexes(app_dir, strict=strict_indexes)
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+    _installed['app_dir'] = app_dir
+    return app_dir
+
+
+def reset():
+    """Empties the datastore, memcache, task queue, outbox and ledger."""
+    from bench.fakes import mail, memcache, ndb, runtime, taskqueue, users
+    ndb.store.reset()
+    memcache.reset()
+    taskqueue.reset()
+    mail.reset()
+    runtime.reset_ledger()
+    runtime.reset_clock()
+    users.state.update(admin=False, email=None)
+
+
+def call(service, method, **fields):
+    """Invokes an endpoint method with a request built from fields."""
+    func = getattr(service, method)
+    request = func.request_class(**fields)
+    return func(request)
+
+
+def applications(app_dir=None):
+    """Yields the WSGI applications named by app.yaml's script handlers."""
+    app_dir = app_dir or _installed['app_dir']
+    seen = set()
+    with open(os.path.join(app_dir, 'app.yaml')) as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith('script:'):
+                continue
+            script = line.split(':', 1)[1].strip()
+            module_name, attr = script.rsplit('.', 1)
+            if script in seen or module_name == 'api':
+                continue
+            seen.add(script)
+            module = __import__(module_name)
+            yield getattr(module, attr)
+
+
+def dispatch(method, path, params=None, body=''):
+    """Routes one request to whichever app.yaml application handles it."""
+    for app in applications():
+        try:
+            return app.dispatch(method, path, params, body)
+        except LookupError:
+            continue
+    raise LookupError('No handler for %s' % path)
+
+
+def run_tasks(max_rounds=100):
+    """Drains the task queue, running each task's handler; returns count."""
+    from bench.fakes import taskqueue
+    ran = 0
+    for _ in range(max_rounds):
+        tasks = taskqueue.pop_all()
+        if not tasks:
+            return ran
+        for task in tasks:
+            params = task.params
+            dispatch(task.method, task.url, params, task.payload or '')
+            ran += 1
+    return ran
+
+
+def run_cron(url):
+    """Runs a cron handler the way the cron service would (GET)."""
+    return dispatch('GET', url)
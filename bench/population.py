@@ -0,0 +1,97 @@
+"""population.py - Seed the in-memory datastore with a realistic population.
+
+Users, finished games' Scores and active Games are written straight through
+ndb in large batches, with ranking aggregates that agree with the Scores,
+then the leaderboard and game counters are rebuilt, so endpoints see the
+same state they would after the population had played through the API.
+Seeding is not charged to the RPC ledger.
+"""
+
+import datetime
+import random
+
+from bench import harness
+from bench.fakes import runtime
+
+BATCH_SIZE = 1000
+ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+def synthetic_word_source(seed=0, per_length=500):
+    """Returns a WordSource of random words, per_length of each length the
+    game allows, so benchmarks never read words.txt."""
+    import words
+
+    class SyntheticWordSource(words.WordSource):
+        def words(self):
+            rng = random.Random(seed)
+            for length in range(words.MIN_WORD_LENGTH,
+                                words.MAX_WORD_LENGTH + 1):
+                for _ in range(per_length):
+                    yield ''.join(rng.choice(ALPHABET)
+                                  for _ in range(length))
+    return SyntheticWordSource()
+
+
+def user_name(index):
+    return 'player%06d' % index
+
+
+def populate(users=10000, scores=1000000, games=20000, seed=0, log=None):
+    """Creates users Users, scores Scores and games active Games. Players
+    are picked with a skew, so a few play far more than most."""
+    import cache
+    import counters
+    import leaderboard
+    import words
+    from google.appengine.ext import ndb
+    from models import Game, Migration, Score, User
+
+    harness.reset()
+    rng = random.Random(seed)
+    words.set_source(synthetic_word_source(seed))
+
+    def pick_user():
+        return int(users * rng.random() ** 2)
+
+    people = [User(key=User.key_for(user_name(i)), name=user_name(i),
+                   email='{}@example.com'.format(user_name(i)))
+              for i in range(users)]
+    today = datetime.date.today()
+    batch = []
+    for i in range(scores):
+        user = people[pick_user()]
+        won = rng.random() < 0.6
+        guesses = rng.randint(5, 26)
+        user.add_score(guesses)
+        batch.append(Score(user=user.key, won=won, guesses=guesses,
+                           date=today - datetime.timedelta(
+                               days=rng.randint(0, 365))))
+        if len(batch) == BATCH_SIZE:
+            ndb.put_multi(batch)
+            batch = []
+            if log and (i + 1) % (BATCH_SIZE * 100) == 0:
+                log('seeded {} scores'.format(i + 1))
+    ndb.put_multi(batch)
+    for start in range(0, users, BATCH_SIZE):
+        ndb.put_multi(people[start:start + BATCH_SIZE])
+    # Every User is name-keyed, as after the migration.
+    Migration(id=cache.USERS_MIGRATION).put()
+
+    batch = []
+    for i in range(games):
+        game = Game.new_game(people[pick_user()].key,
+                             rng.randint(words.MIN_WORD_LENGTH,
+                                         words.MAX_WORD_LENGTH))
+        batch.append(game)
+        if len(batch) == BATCH_SIZE:
+            ndb.put_multi(batch)
+            batch = []
+    ndb.put_multi(batch)
+
+    leaderboard.rebuild()
+    counters.rebuild()
+    runtime.reset_ledger()
+    if log:
+        log('seeded {} users, {} scores, {} games'.format(users, scores,
+                                                          games))
@@ -0,0 +1,266 @@
+"""run.py - Benchmark the Hangman API endpoints against in-memory services.
+
+Seeds a population (see population.py), then drives each endpoint in turn
+and reports throughput, p50/p99 latency, RPCs per call and round trips per
+call, the depth of its longest chain of dependent RPCs:
+
+    python -m bench.run                        # 10k users, 1M scores
+    python -m bench.run --scale 0.01           # 1% of that, for a quick run
+    python -m bench.run --save baseline.json
+    python -m bench.run --compare baseline.json
+
+Latencies are those of the in-memory stand-ins, so they are comparable
+between runs on one machine rather than with production. RPC and round-trip
+counts do not depend on the machine: any increase in them is reported. With
+--compare the run exits with status 1 if any endpoint regressed.
+"""
+
+import argparse
+import json
+import random
+import sys
+import timeit
+
+from bench import harness, population
+from bench.fakes import runtime
+
+DEFAULT_SCENARIOS = ['create_user', 'new_game', 'make_move', 'get_scores',
+                     'get_high_scores', 'get_user_rankings']
+
+
+class Context(object):
+    """State the scenarios share: the service, the population and the
+    games and cursors that calls carry from one op to the next."""
+
+    def __init__(self, service, users, rng):
+        self.service = service
+        self.users = users
+        self.rng = rng
+        self.created = 0
+        self.moves = []
+        self.cursors = {}
+
+    def random_user(self):
+        return population.user_name(self.rng.randrange(self.users))
+
+    def next_move(self):
+        """Returns (urlsafe game key, letter) of the next move to make,
+        starting a new game when the current one has no letters left"""
+        import words
+        while not self.moves:
+            game = harness.call(self.service, 'new_game',
+                                user_name=self.random_user(),
+                                word_length=self.rng.randint(
+                                    words.MIN_WORD_LENGTH,
+                                    words.MAX_WORD_LENGTH))
+            letters = list(population.ALPHABET)
+            self.rng.shuffle(letters)
+            self.moves = [(game.urlsafe_key, letter) for letter in letters]
+        return self.moves.pop()
+
+    def paged(self, method, **fields):
+        """Returns a call that reads the page after the one this method
+        last read, so a run walks deep pages as well as the first"""
+        def call():
+            result = harness.call(self.service, method,
+                                  cursor=self.cursors.get(method), **fields)
+            self.cursors[method] = result.next_cursor
+        return call
+
+
+def _create_user(ctx):
+    ctx.created += 1
+    name = 'bench%08d' % ctx.created
+    return lambda: harness.call(ctx.service, 'create_user', user_name=name,
+                                email=name + '@example.com')
+
+
+def _new_game(ctx):
+    import words
+    name = ctx.random_user()
+    length = ctx.rng.randint(words.MIN_WORD_LENGTH, words.MAX_WORD_LENGTH)
+    return lambda: harness.call(ctx.service, 'new_game', user_name=name,
+                                word_length=length)
+
+
+def _make_move(ctx):
+    urlsafe, letter = ctx.next_move()
+    return lambda: harness.call(ctx.service, 'make_move',
+                                urlsafe_game_key=urlsafe, guess=letter)
+
+
+def _get_scores(ctx):
+    return ctx.paged('get_scores')
+
+
+def _get_high_scores(ctx):
+    return lambda: harness.call(ctx.service, 'get_high_scores',
+                                number_of_records=10)
+
+
+def _get_user_rankings(ctx):
+    return ctx.paged('get_user_rankings')
+
+
+# Each scenario prepares one call, untimed, and returns it.
+SCENARIOS = {
+    'create_user': _create_user,
+    'new_game': _new_game,
+    'make_move': _make_move,
+    'get_scores': _get_scores,
+    'get_high_scores': _get_high_scores,
+    'get_user_rankings': _get_user_rankings,
+}
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(ctx, scenario, ops, warmup=0):
+    """Runs warmup untimed calls of one scenario, which build the indexes
+    and fill the caches it uses, then ops timed calls. Returns its
+    metrics"""
+    prepare = SCENARIOS[scenario]
+    for _ in range(warmup):
+        prepare(ctx)()
+    latencies = []
+    datastore = memcache = trips = 0
+    for _ in range(ops):
+        call = prepare(ctx)
+        harness.run_tasks()
+        before = runtime.snapshot()
+        trips -= runtime.round_trips()
+        start = timeit.default_timer()
+        call()
+        latencies.append(timeit.default_timer() - start)
+        trips += runtime.round_trips()
+        after = runtime.snapshot()
+        after.subtract(before)
+        datastore += runtime.datastore_rpcs(after)
+        memcache += sum(v for k, v in after.items()
+                        if k.startswith('memcache.'))
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'ops': ops,
+        'ops_per_sec': ops / total if total else 0.0,
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'datastore_rpcs': float(datastore) / ops,
+        'memcache_rpcs': float(memcache) / ops,
+        'round_trips': float(trips) / ops,
+    }
+
+
+def run(scenarios, ops, users, scores, games, seed=0, warmup=10, log=None):
+    """Seeds the population and measures each scenario. Returns a dict of
+    the configuration and each scenario's metrics"""
+    harness.install()
+    population.populate(users, scores, games, seed=seed, log=log)
+    import api
+    # The app draws words and counter shards from the random module.
+    random.seed(seed)
+    ctx = Context(api.HangmanApi(), users, random.Random(seed))
+    results = {}
+    for scenario in scenarios:
+        results[scenario] = measure(ctx, scenario, ops, warmup)
+        if log:
+            log('ran {}'.format(scenario))
+    return {'config': {'users': users, 'scores': scores, 'games': games,
+                       'ops': ops, 'seed': seed, 'warmup': warmup},
+            'results': results}
+
+
+def compare(current, baseline, threshold):
+    """Returns a description of each regression of current against
+    baseline: throughput or median latency worse by more than threshold, or
+    any increase in RPCs or round trips per call. p99 is too noisy over a
+    short run to compare"""
+    regressions = []
+    for scenario, now in sorted(current['results'].items()):
+        before = baseline['results'].get(scenario)
+        if before is None:
+            continue
+        if now['ops_per_sec'] < before['ops_per_sec'] * (1 - threshold):
+            regressions.append('{}: {:.0f} ops/s, was {:.0f}'.format(
+                scenario, now['ops_per_sec'], before['ops_per_sec']))
+        if now['p50_ms'] > before['p50_ms'] * (1 + threshold):
+            regressions.append('{}: p50 {:.2f} ms, was {:.2f}'.format(
+                scenario, now['p50_ms'], before['p50_ms']))
+        for metric, label in (('datastore_rpcs', 'datastore RPCs'),
+                              ('memcache_rpcs', 'memcache RPCs'),
+                              ('round_trips', 'round trips')):
+            # Baselines saved before round trips were measured lack them.
+            if metric in before and now[metric] > before[metric] + 0.01:
+                regressions.append(
+                    '{}: {:.2f} {} per call, was {:.2f}'.format(
+                        scenario, now[metric], label, before[metric]))
+    return regressions
+
+
+def report(current, baseline=None):
+    """Formats the results as a table, with the baseline's throughput and
+    datastore RPCs alongside when given"""
+    lines = ['{:<20} {:>10} {:>9} {:>9} {:>10} {:>10} {:>8}'.format(
+        'endpoint', 'ops/s', 'p50 ms', 'p99 ms', 'ds rpc', 'mc rpc',
+        'trips')]
+    for scenario, m in sorted(current['results'].items()):
+        line = ('{:<20} {:>10.0f} {:>9.2f} {:>9.2f} {:>10.2f} {:>10.2f} '
+                '{:>8.2f}').format(
+            scenario, m['ops_per_sec'], m['p50_ms'], m['p99_ms'],
+            m['datastore_rpcs'], m['memcache_rpcs'], m['round_trips'])
+        before = (baseline or {}).get('results', {}).get(scenario)
+        if before:
+            line += '   (was {:.0f} ops/s, {:.2f} ds rpc)'.format(
+                before['ops_per_sec'], before['datastore_rpcs'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--scores', type=int, default=1000000)
+    parser.add_argument('--games', type=int, default=20000)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplies the population sizes')
+    parser.add_argument('--ops', type=int, default=1000,
+                        help='calls per endpoint')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='untimed calls per endpoint before timing')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='endpoint to run; repeat for several '
+                        '(default: all)')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='tolerated throughput/latency change '
+                        '(default 0.2)')
+    args = parser.parse_args(argv)
+
+    def log(message):
+        sys.stderr.write(message + '\n')
+    current = run(args.scenario or DEFAULT_SCENARIOS, args.ops,
+                  max(1, int(args.users * args.scale)),
+                  int(args.scores * args.scale),
+                  int(args.games * args.scale), args.seed, args.warmup, log)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(report(current, baseline))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(current, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,381 @@
+"""bulk.py - Bulk import of Users, Games and Scores.
+
+An ImportJob takes its records in parts, over one or more import_records
+calls; the final part seals it. Each part is split into ImportChunks of
+CHUNK_SIZE records, stored with the job in one transaction that also queues
+their tasks. A chunk task writes its records with one put_multi, then marks
+the chunk done and counts its Games in one cross-group transaction that
+leaves the ImportJob alone, so chunks are written in parallel. Imported
+entities are keyed after their job, chunk and position, so a retried chunk
+rewrites the same entities. Once every chunk of a sealed job is done, a
+finishing task, delayed by FINISH_DELAY seconds for the indexes to catch
+up, rebuilds the leaderboards and the rankings of the Users the job
+touched."""
+
+import collections
+import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import cache
+import counters
+import debounce
+import leaderboard
+import moves
+import rankings
+import words
+from models import Game, ImportChunk, ImportChunkDone, ImportJob, \
+    ImportJobForm, ImportUsers, Score, User, letter_bit
+
+# Half the entities a put_multi may carry: each record writes at most two.
+CHUNK_SIZE = 250
+MAX_RECORDS = 10000
+TASK_BATCH_SIZE = 100
+QUEUE_NAME = 'import'
+QUEUE_URL = '/tasks/import_part'
+CHUNK_URL = '/tasks/import_chunk'
+FINISH_URL = '/tasks/import_finish'
+RANKINGS_URL = '/tasks/rebuild_rankings'
+FINISH_DELAY = 60
+USER = 'user'
+GAME = 'game'
+SCORE = 'score'
+
+
+def _user_record(form):
+    if not form.name:
+        raise ValueError('A User needs a name!')
+    return [USER, {'name': form.name, 'email': form.email}]
+
+
+def _game_record(form):
+    if form.word:
+        word = form.word.upper()
+        if not all(letter_bit(letter) for letter in word):
+            raise ValueError('Invalid word {}!'.format(form.word))
+    else:
+        word = None
+    length = len(word) if word else form.word_length
+    if not words.MIN_WORD_LENGTH <= length <= words.MAX_WORD_LENGTH:
+        raise ValueError('Word must be between 10 and 20!')
+    guesses = [guess.upper() for guess in form.guesses]
+    if not all(letter_bit(guess) for guess in guesses):
+        raise ValueError('Guesses must be single letters (A-Z)!')
+    # Drawn now, so a retried chunk replays the same word.
+    return [GAME, {'user_name': form.user_name,
+                   'word': word or words.random_word(length),
+                   'guesses': guesses,
+                   'cancelled': bool(form.cancelled)}]
+
+
+def _parse_date(text):
+    return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def _score_record(form):
+    try:
+        _parse_date(form.date)
+    except ValueError:
+        raise ValueError('Invalid date {}!'.format(form.date))
+    if form.guesses < 0:
+        raise ValueError('Guesses cannot be negative!')
+    return [SCORE, {'user_name': form.user_name, 'date': form.date,
+                    'won': form.won, 'guesses': form.guesses}]
+
+
+def _resolve_users(job_id, records, imported):
+    """Points each Game and Score record at the key of the User it names:
+    one that exists, or one named in imported or by an earlier part of the
+    job. Raises ValueError naming any other users"""
+    named = set(record['user_name'] for kind, record in records
+                if kind != USER)
+    keys = dict((name, User.key_for(name)) for name in named & imported)
+    futures = dict((name, cache.get_user_key_async(name))
+                   for name in named - imported)
+    missing = set()
+    for name, future in futures.items():
+        key = future.get_result()
+        if key:
+            keys[name] = key
+        else:
+            missing.add(name)
+    if missing and job_id is not None:
+        for part in ImportUsers.query(ancestor=ndb.Key(ImportJob, job_id)):
+            for name in missing.intersection(part.names):
+                keys[name] = User.key_for(name)
+            missing.difference_update(part.names)
+    if missing:
+        raise ValueError('No users named {}!'.format(
+            ', '.join(sorted(missing))))
+    for kind, record in records:
+        if kind != USER:
+            record['user'] = keys[record['user_name']].urlsafe()
+
+
+@ndb.transactional_tasklet
+def _merge_user_async(record):
+    """Creates the User a record names, or gives the existing User the
+    record's email if it has one. The User's other fields, its ranking
+    aggregates among them, are kept"""
+    key = User.key_for(record['name'])
+    user = yield key.get_async()
+    if user is None:
+        user = User(key=key, name=record['name'], email=record['email'])
+    elif record['email'] and user.email != record['email']:
+        user.email = record['email']
+    else:
+        raise ndb.Return()
+    yield user.put_async()
+
+
+def _write_users(records):
+    """Merges User records into the Users, in a transaction for each User
+    the records add or change"""
+    users = ndb.get_multi([User.key_for(record['name'])
+                           for record in records])
+    futures = [_merge_user_async(record)
+               for record, user in zip(records, users)
+               if user is None or (record['email'] and
+                                   user.email != record['email'])]
+    for future in futures:
+        future.get_result()
+
+
+def _game(record, entity_id):
+    word = record['word']
+    game = Game.new_game(ndb.Key(urlsafe=record['user']), len(word),
+                         word=word, id=entity_id)
+    entities = [game]
+    for guess in record['guesses']:
+        message, changed, won = moves.apply_guess(game, guess)
+        if won is not None:
+            score = game.end_game(won)
+            score.key = ndb.Key(Score, entity_id)
+            entities.append(score)
+            break
+    if record['cancelled'] and not game.game_over:
+        game.cancel_game()
+    return entities
+
+
+def _score(record, entity_id):
+    return [Score(id=entity_id, user=ndb.Key(urlsafe=record['user']),
+                  date=_parse_date(record['date']), won=record['won'],
+                  guesses=record['guesses'])]
+
+
+_BUILDERS = {GAME: _game, SCORE: _score}
+
+
+def _count(entities):
+    """Returns the game counter deltas of the Games among entities"""
+    deltas = collections.Counter()
+    for entity in entities:
+        if not isinstance(entity, Game):
+            continue
+        deltas[counters.games_of_length(entity.word_length)] += 1
+        if entity.cancelled:
+            deltas[counters.CANCELLED_GAMES] += 1
+        elif entity.game_over:
+            deltas[counters.FINISHED_GAMES] += 1
+        else:
+            deltas[counters.ACTIVE_GAMES] += 1
+    return dict(deltas)
+
+
+def _done_counter(job_id):
+    return 'import_done_{}'.format(job_id)
+
+
+def _done_key(job_id, chunk):
+    return ndb.Key(ImportChunkDone, '{}-{}'.format(job_id, chunk))
+
+
+def _finish_if_complete(job_id):
+    """Queues the finishing task if the ImportJob is sealed and every chunk
+    is written. Call it after marking a chunk done or sealing the job, once
+    that has committed: whichever commits last sees the job complete. The
+    task is named after the job, so it is queued once"""
+    job = ImportJob.get_by_id(job_id)
+    if not job.sealed:
+        return
+    done = _done_counter(job_id)
+    if counters.sum_shards([done])[done] < job.chunks:
+        return
+    try:
+        taskqueue.add(url=FINISH_URL, name='import-finish-{}'.format(job_id),
+                      params={'job': job_id}, queue_name=QUEUE_NAME,
+                      countdown=FINISH_DELAY)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+def add_records(job_id, users, games, scores, final=True):
+    """Queues UserRecordForms, GameRecordForms and ScoreRecordForms for
+    import as part of the ImportJob with id job_id, or of a new ImportJob if
+    job_id is None; final seals the job. Returns the ImportJob, or None if
+    there is no such job. Raises ValueError for an invalid record, a user
+    that neither exists nor is imported, or a sealed job"""
+    records = ([_user_record(form) for form in users] +
+               [_game_record(form) for form in games] +
+               [_score_record(form) for form in scores])
+    if job_id is None and not records:
+        raise ValueError('No records to import!')
+    if len(records) > MAX_RECORDS:
+        raise ValueError('At most {} records per request!'.format(
+            MAX_RECORDS))
+    names = set(record['name'] for kind, record in records if kind == USER)
+    _resolve_users(job_id, records, names)
+    touched = set(User.key_for(name) for name in names)
+    touched.update(ndb.Key(urlsafe=record['user'])
+                   for kind, record in records if kind != USER)
+    count = (len(records) + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+    def txn():
+        if job_id is None:
+            job = ImportJob()
+        else:
+            job = ImportJob.get_by_id(job_id)
+            if job is None:
+                return None
+            if job.sealed:
+                raise ValueError('Import {} is already sealed!'.format(
+                    job_id))
+        first = job.chunks
+        job.chunks += count
+        job.records += len(records)
+        job.sealed = final
+        job.put()
+        entities = [ImportChunk(parent=job.key, id=first + number,
+                                records=records[number * CHUNK_SIZE:
+                                                (number + 1) * CHUNK_SIZE])
+                    for number in range(count)]
+        if touched:
+            entities.append(ImportUsers(parent=job.key, names=sorted(names),
+                                        keys=sorted(touched)))
+        ndb.put_multi(entities)
+        if count or final:
+            taskqueue.add(url=QUEUE_URL, queue_name=QUEUE_NAME,
+                          params={'job': job.key.id(), 'first': first,
+                                  'count': count},
+                          transactional=True)
+        return job
+
+    return ndb.transaction(txn)
+
+
+def _chunk_task(job_id, chunk):
+    return taskqueue.Task(url=CHUNK_URL,
+                          name='import-{}-{}'.format(job_id, chunk),
+                          params={'job': job_id, 'chunk': chunk})
+
+
+def queue_chunks(job_id, first, count):
+    """Queues the tasks that write count chunks of an ImportJob, from chunk
+    first, then finishes the job if it is complete. The tasks are named
+    after their chunks, so a retry queues none twice"""
+    queue = taskqueue.Queue(QUEUE_NAME)
+    chunks = range(first, first + count)
+    for start in range(0, count, TASK_BATCH_SIZE):
+        batch = chunks[start:start + TASK_BATCH_SIZE]
+        try:
+            queue.add([_chunk_task(job_id, chunk) for chunk in batch])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # A retry: queue whichever of the batch are missing.
+            for chunk in batch:
+                try:
+                    queue.add(_chunk_task(job_id, chunk))
+                except (taskqueue.TaskAlreadyExistsError,
+                        taskqueue.TombstonedTaskError):
+                    pass
+    _finish_if_complete(job_id)
+
+
+def write_chunk(job_id, chunk):
+    """Writes one chunk of an ImportJob's records, marks it done and
+    counts its Games"""
+    stored, marker = ndb.get_multi([
+        ndb.Key(ImportJob, job_id, ImportChunk, chunk),
+        _done_key(job_id, chunk)])
+    if stored is None:
+        # The job is finished.
+        return
+    if marker is not None:
+        # Written already; the Games may have been played since.
+        _finish_if_complete(job_id)
+        return
+    users = []
+    entities = []
+    for index, (kind, record) in enumerate(stored.records):
+        if kind == USER:
+            users.append(record)
+            continue
+        entity_id = 'import-{}-{}-{}'.format(job_id, chunk, index)
+        entities.extend(_BUILDERS[kind](record, entity_id))
+    _write_users(users)
+    ndb.put_multi(entities)
+    deltas = _count(entities)
+    deltas[_done_counter(job_id)] = 1
+
+    def txn():
+        key = _done_key(job_id, chunk)
+        if key.get() is not None:
+            return False
+        ndb.put_multi([ImportChunkDone(key=key)] + counters.prepare(deltas))
+        return True
+    if ndb.transaction(txn, xg=True):
+        counters.update_cache(deltas)
+    _finish_if_complete(job_id)
+
+
+def _rebuild_rankings(job_key):
+    """Queues the ranking rebuild of the Users an ImportJob touched, one
+    task per batch of them"""
+    touched = set()
+    for part in ImportUsers.query(ancestor=job_key):
+        touched.update(part.keys)
+    touched = sorted(touched)
+    size = rankings.REBUILD_BATCH_SIZE
+    tasks = [taskqueue.Task(url=RANKINGS_URL, params={
+        'user': [key.urlsafe() for key in touched[start:start + size]]})
+        for start in range(0, len(touched), size)]
+    for start in range(0, len(tasks), TASK_BATCH_SIZE):
+        taskqueue.Queue().add(tasks[start:start + TASK_BATCH_SIZE])
+
+
+def finish(job_id):
+    """Rebuilds what a completed ImportJob's records feed: the leaderboards
+    and the rankings"""
+    today = datetime.date.today()
+    leaderboard.rebuild()
+    leaderboard.rebuild_bucket(leaderboard.DAILY, today)
+    leaderboard.rebuild_bucket(leaderboard.WEEKLY, today)
+    job = ImportJob.get_by_id(job_id)
+    _rebuild_rankings(job.key)
+    debounce.schedule('/tasks/cache_average_attempts')
+    # The chunks go first: a chunk task that runs again finds no chunk and
+    # so never finds its marker gone.
+    ndb.delete_multi(ImportChunk.query(ancestor=job.key).fetch(
+        keys_only=True))
+    ndb.delete_multi([_done_key(job_id, chunk)
+                      for chunk in range(job.chunks)])
+    job.finished = datetime.datetime.now()
+    job.put()
+
+
+def get_job(job_id):
+    """Returns the ImportJob with id job_id, or None"""
+    return ImportJob.get_by_id(job_id)
+
+
+def to_form(job):
+    """Returns an ImportJobForm of an ImportJob"""
+    done = _done_counter(job.key.id())
+    return ImportJobForm(job_id=job.key.id(), records=job.records,
+                         chunks=job.chunks,
+                         done=counters.sum_shards([done])[done],
+                         sealed=job.sealed,
+                         finished=str(job.finished) if job.finished else None)
@@ -0,0 +1,296 @@
+"""cache.py - Read-through cache for entities looked up by urlsafe key.
+
+Two tiers sit in front of the datastore: a bounded in-process LRU and
+memcache. Cached entities carry the version they were written with (see
+Game.version, which every put bumps), and memcache also holds each key's
+current version. A read fetches that version first and only serves a copy
+whose version matches, so once a write has published its version no reader
+is handed the entity as it was before the write. Writers call publish()
+after their transaction commits, and publish_later() inside it, so the
+version is published even if the request dies in between.
+
+The lookups and publish() also come as tasklets (the _async functions), so
+callers can run them alongside their other RPCs.
+
+Entities returned from the cache are shared with other requests on the same
+instance and must not be modified; writes read the entity in a transaction.
+"""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Migration, User
+from utils import get_key_by_urlsafe
+import stats
+
+LOCAL_CACHE_SIZE = 1000
+MEMCACHE_TIME = 60 * 60
+PUBLISH_RETRIES = 3
+PUBLISH_URL = '/tasks/publish'
+VERSION_PREFIX = 'version:'
+ENTITY_PREFIX = 'entity:'
+USER_NAME_PREFIX = 'user_name:'
+USER_KEY_PREFIX = 'user_key:'
+# Resolutions to a not yet migrated User go stale when it is migrated, so
+# they are only kept briefly and never in-process.
+LEGACY_USER_KEY_TIME = 60
+# The Migration that moves every User to a name key; until it completes, a
+# name without a name-keyed User is looked up by query.
+USERS_MIGRATION = 'users'
+STATS_PREFIX = 'cache.'
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded, least recently used dict"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                _count('evictions')
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_entities = LRUCache(LOCAL_CACHE_SIZE)
+_user_names = LRUCache(LOCAL_CACHE_SIZE)
+_user_keys = LRUCache(LOCAL_CACHE_SIZE)
+# Completed migrations are remembered for good; pending ones are rechecked
+# at most every LEGACY_USER_KEY_TIME seconds.
+_migration = {'done': False, 'checked': 0.0}
+
+
+def _count(name):
+    # Reported by get_stats alongside the RPCs of the endpoint being served.
+    stats.count(STATS_PREFIX + name)
+
+
+def get_by_urlsafe(urlsafe, model):
+    """Returns the entity of a versioned model that a urlsafe key points
+    to, or None if it does not exist"""
+    key = get_key_by_urlsafe(urlsafe, model)
+    version = memcache.get(VERSION_PREFIX + urlsafe)
+    if version is not None:
+        local = _entities.get(urlsafe)
+        if local is not None and local[0] == version:
+            _count('entity_local_hits')
+            return local[1]
+        cached = memcache.get(ENTITY_PREFIX + urlsafe)
+        if cached is not None and cached[0] == version:
+            _count('entity_memcache_hits')
+            _entities.set(urlsafe, cached)
+            return cached[1]
+        _count('entity_stale')
+    _count('entity_misses')
+    entity = key.get()
+    if entity is None:
+        return None
+    entry = (entity.version, entity)
+    if version is None:
+        # add, not set: if a write published a newer version since this
+        # read, it must win.
+        fresh = memcache.add(VERSION_PREFIX + urlsafe, entity.version,
+                             time=MEMCACHE_TIME)
+    else:
+        fresh = version == entity.version
+    if fresh:
+        memcache.set(ENTITY_PREFIX + urlsafe, entry, time=MEMCACHE_TIME)
+    _entities.set(urlsafe, entry)
+    return entity
+
+
+def publish(entity):
+    """Makes a committed write visible to readers. Call it after the
+    transaction that wrote entity has committed"""
+    publish_async(entity).get_result()
+
+
+@ndb.tasklet
+def publish_async(entity):
+    """Asynchronous publish"""
+    urlsafe = entity.key.urlsafe()
+    entry = (entity.version, entity)
+    published = yield _publish_version_async(VERSION_PREFIX + urlsafe,
+                                             entity.version)
+    if published:
+        yield ndb.get_context().memcache_set(ENTITY_PREFIX + urlsafe, entry,
+                                             time=MEMCACHE_TIME)
+        _entities.set(urlsafe, entry)
+
+
+def publish_later(entity):
+    """Queues a task that publishes entity as it is in the datastore. Call
+    it in the transaction that writes entity"""
+    publish_later_async(entity).get_result()
+
+
+def publish_later_async(entity):
+    """Asynchronous publish_later. Returns a Future"""
+    return taskqueue.Queue().add_async(
+        taskqueue.Task(url=PUBLISH_URL,
+                       params={'key': entity.key.urlsafe()}),
+        transactional=True)
+
+
+@ndb.tasklet
+def _publish_version_async(version_key, version):
+    """Raises the version held in memcache to version with compare-and-set,
+    so writers that publish out of order never move it backwards. Returns
+    True if version is now the current one"""
+    context = ndb.get_context()
+    for _ in range(PUBLISH_RETRIES):
+        current = yield context.memcache_gets(version_key)
+        if current is None:
+            added = yield context.memcache_add(version_key, version,
+                                               time=MEMCACHE_TIME)
+            if added:
+                raise ndb.Return(True)
+        elif current >= version:
+            raise ndb.Return(current == version)
+        else:
+            stored = yield context.memcache_cas(version_key, version,
+                                                time=MEMCACHE_TIME)
+            if stored:
+                raise ndb.Return(True)
+    # Could not publish: drop the version so readers go to the datastore
+    # rather than match an old copy against an old version.
+    yield context.memcache_delete(version_key)
+    raise ndb.Return(False)
+
+
+def forget(keys):
+    """Drops deleted entities from the cache"""
+    urlsafes = [key.urlsafe() for key in keys]
+    if not urlsafes:
+        return
+    # Without a version, readers go to the datastore and find nothing.
+    memcache.delete_multi([prefix + urlsafe for urlsafe in urlsafes
+                           for prefix in (VERSION_PREFIX, ENTITY_PREFIX)])
+    for urlsafe in urlsafes:
+        _entities.delete(urlsafe)
+
+
+def set_versioned(key, version, value):
+    """Stores (version, value) in memcache unless a newer version is already
+    there, so mirrors written out of order never go backwards"""
+    client = memcache.Client()
+    for _ in range(PUBLISH_RETRIES):
+        current = client.gets(key)
+        if current is None:
+            if memcache.add(key, (version, value), time=MEMCACHE_TIME):
+                return
+        elif current[0] >= version:
+            return
+        elif client.cas(key, (version, value), time=MEMCACHE_TIME):
+            return
+    memcache.delete(key)
+
+
+def get_user_name(user_key):
+    """Returns a User's name. Names never change, so cached copies never go
+    stale"""
+    return get_user_name_async(user_key).get_result()
+
+
+@ndb.tasklet
+def get_user_name_async(user_key):
+    """Asynchronous get_user_name"""
+    urlsafe = user_key.urlsafe()
+    name = _user_names.get(urlsafe)
+    if name is not None:
+        _count('user_name_local_hits')
+        raise ndb.Return(name)
+    context = ndb.get_context()
+    name = yield context.memcache_get(USER_NAME_PREFIX + urlsafe)
+    if name is not None:
+        _count('user_name_memcache_hits')
+    else:
+        _count('user_name_misses')
+        user = yield user_key.get_async()
+        name = user.name
+        yield context.memcache_set(USER_NAME_PREFIX + urlsafe, name,
+                                   time=MEMCACHE_TIME)
+    _user_names.set(urlsafe, name)
+    raise ndb.Return(name)
+
+
+def get_user_key(name):
+    """Resolves a user name to its User's key. Returns None if there is no
+    such User"""
+    return get_user_key_async(name).get_result()
+
+
+@ndb.tasklet
+def get_user_key_async(name):
+    """Asynchronous get_user_key"""
+    if not name:
+        raise ndb.Return(None)
+    key = _user_keys.get(name)
+    if key is not None:
+        _count('user_key_local_hits')
+        raise ndb.Return(key)
+    context = ndb.get_context()
+    urlsafe = yield context.memcache_get(USER_KEY_PREFIX + name)
+    if urlsafe is not None:
+        _count('user_key_memcache_hits')
+        key = ndb.Key(urlsafe=urlsafe)
+    else:
+        _count('user_key_misses')
+        key = User.key_for(name)
+        user = yield key.get_async()
+        if user is None:
+            migrated = yield _users_migrated_async()
+            if migrated:
+                raise ndb.Return(None)
+            key = yield User.query(User.name == name).get_async(
+                keys_only=True)
+            if key is None:
+                raise ndb.Return(None)
+            yield context.memcache_set(USER_KEY_PREFIX + name, key.urlsafe(),
+                                       time=LEGACY_USER_KEY_TIME)
+            raise ndb.Return(key)
+        yield context.memcache_set(USER_KEY_PREFIX + name, key.urlsafe(),
+                                   time=MEMCACHE_TIME)
+    if key.id() == name:
+        _user_keys.set(name, key)
+    raise ndb.Return(key)
+
+
+@ndb.tasklet
+def _users_migrated_async():
+    if not _migration['done'] and (
+            time.time() - _migration['checked'] >= LEGACY_USER_KEY_TIME):
+        _migration['checked'] = time.time()
+        marker = yield ndb.Key(Migration, USERS_MIGRATION).get_async()
+        _migration['done'] = marker is not None
+    raise ndb.Return(_migration['done'])
+
+
+def forget_user_key(name):
+    """Drops a cached resolution of name, after its User was migrated"""
+    memcache.delete(USER_KEY_PREFIX + name)
@@ -0,0 +1,139 @@
+"""counters.py - Sharded counters for game statistics.
+
+Each named counter is the sum of NUM_SHARDS CounterShard entities. A write
+adds to one shard picked at random, so concurrent games rarely contend on
+the same entity group. Totals are cached in memcache and adjusted with
+offset_multi after each committed write; on a cache miss a total is
+recomputed with one multi-get of its shards, so reads cost O(shards) no
+matter how many games exist."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import archive
+from models import CounterShard, Game
+import words
+
+ACTIVE_GAMES = 'games_active'
+FINISHED_GAMES = 'games_finished'
+CANCELLED_GAMES = 'games_cancelled'
+NUM_SHARDS = 20
+MEMCACHE_PREFIX = 'counter:'
+# Totals are recomputed at least this often, which bounds the drift from an
+# increment that lands while a total is being recomputed.
+MEMCACHE_TIME = 60
+
+
+def games_of_length(word_length):
+    """Returns the name of the counter of games with the given word length"""
+    return 'games_length_{}'.format(word_length)
+
+
+def _shard_keys(name):
+    return [ndb.Key(CounterShard, '{}:{}'.format(name, index))
+            for index in range(NUM_SHARDS)]
+
+
+def prepare(deltas):
+    """Applies deltas, a dict of counter name -> amount, to one random shard
+    per counter. Returns the shards for the caller to put, normally in the
+    same transaction as the change being counted. Call update_cache once
+    that transaction commits"""
+    return prepare_async(deltas).get_result()
+
+
+@ndb.tasklet
+def prepare_async(deltas):
+    """Asynchronous prepare, so the shards can be read alongside the
+    entities whose change they count"""
+    keys = [random.choice(_shard_keys(name)) for name in deltas]
+    shards = yield ndb.get_multi_async(keys)
+    for index, (key, name) in enumerate(zip(keys, deltas)):
+        if shards[index] is None:
+            shards[index] = CounterShard(key=key, name=name)
+        shards[index].count += deltas[name]
+    raise ndb.Return(shards)
+
+
+def update_cache(deltas):
+    """Adjusts the cached totals after a committed write. Totals that are
+    not cached are left to be recomputed on their next read"""
+    update_cache_async(deltas).get_result()
+
+
+def update_cache_async(deltas):
+    """Starts update_cache. Returns an RPC to wait on"""
+    return memcache.Client().offset_multi_async(deltas,
+                                                key_prefix=MEMCACHE_PREFIX)
+
+
+def sum_shards(names):
+    """Returns a dict of counter name -> total read from the shards rather
+    than the cache, so it includes every committed write"""
+    keys = []
+    for name in names:
+        keys.extend(_shard_keys(name))
+    totals = dict((name, 0) for name in names)
+    for shard in ndb.get_multi(keys):
+        if shard is not None:
+            totals[shard.name] += shard.count
+    return totals
+
+
+def get_counts(names):
+    """Returns a dict of counter name -> total"""
+    counts = memcache.get_multi(names, key_prefix=MEMCACHE_PREFIX)
+    missing = [name for name in names if name not in counts]
+    if missing:
+        totals = sum_shards(missing)
+        # add, not set: an increment cached since the shards were read
+        # must not be overwritten with an older total.
+        memcache.add_multi(totals, key_prefix=MEMCACHE_PREFIX,
+                           time=MEMCACHE_TIME)
+        counts.update(totals)
+    return counts
+
+
+def refresh(names):
+    """Recomputes the cached totals of the given counters from their
+    shards"""
+    totals = sum_shards(names)
+    memcache.set_multi(totals, key_prefix=MEMCACHE_PREFIX, time=MEMCACHE_TIME)
+    return totals
+
+
+def get_count(name):
+    """Returns the total of one counter"""
+    return get_counts([name])[name]
+
+
+def rebuild():
+    """Recounts every game counter from the Games and resets the shards.
+    Used to initialise the counters for Games created before they existed;
+    games started or ended while it runs may be miscounted. Archived Games
+    count too, though those archived before their word length was kept
+    count only as finished or cancelled"""
+    finished, cancelled, lengths = archive.totals()
+    totals = {
+        ACTIVE_GAMES: Game.query(Game.game_over == False,
+                                 Game.cancelled == False).count(),
+        FINISHED_GAMES: Game.query(Game.game_over == True).count() +
+        finished,
+        CANCELLED_GAMES: Game.query(Game.cancelled == True).count() +
+        cancelled,
+    }
+    for word_length in range(words.MIN_WORD_LENGTH,
+                             words.MAX_WORD_LENGTH + 1):
+        totals[games_of_length(word_length)] = (
+            Game.query(Game.word_length == word_length).count() +
+            lengths.get(word_length, 0))
+    shards = []
+    for name, total in totals.items():
+        keys = _shard_keys(name)
+        shards.append(CounterShard(key=keys[0], name=name, count=total))
+        shards.extend(CounterShard(key=key, name=name) for key in keys[1:])
+    ndb.put_multi(shards)
+    memcache.delete_multi(totals.keys(), key_prefix=MEMCACHE_PREFIX)
+    return totals
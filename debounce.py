@@ -0,0 +1,60 @@
+"""debounce.py - Coalesced background recomputation tasks.
+
+Jobs that recompute derived data (cached statistics, rankings) only need to
+run once after a burst of changes, not once per change. schedule() divides
+time into windows and enqueues at most one task per job and window: the
+task is named after the job and the window, and is delayed to the window's
+end, so it sees every change made during the window. Later requests in the
+window find the task already scheduled, first in an in-process record, then
+in memcache, so a burst costs about one task queue call per window however
+many requests it has; if both miss, the task name still refuses a
+duplicate."""
+
+import logging
+import re
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+DEFAULT_WINDOW = 60
+MEMCACHE_PREFIX = 'debounce:'
+
+_lock = threading.Lock()
+# Job name -> the last window this instance scheduled it for
+_scheduled = {}
+
+
+def _job_name(url):
+    return re.sub(r'[^a-zA-Z0-9_-]', '-', url.strip('/'))
+
+
+def schedule(url, window=DEFAULT_WINDOW, queue_name='default'):
+    """Schedules a POST to url at the end of the current window of window
+    seconds, unless one is already scheduled. Returns True if this call
+    enqueued the task"""
+    now = time.time()
+    slot = int(now // window)
+    job = _job_name(url)
+    with _lock:
+        if _scheduled.get(job) == slot:
+            return False
+        _scheduled[job] = slot
+    name = '{}-{}-{}'.format(job, window, slot)
+    if not memcache.add(MEMCACHE_PREFIX + name, True, time=window):
+        return False
+    try:
+        taskqueue.add(url=url, name=name, queue_name=queue_name,
+                      countdown=max(0, (slot + 1) * window - now))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        logging.info('Task %s already scheduled', name)
+        return False
+    except Exception:
+        # Let the next request in the window try again.
+        with _lock:
+            _scheduled.pop(job, None)
+        memcache.delete(MEMCACHE_PREFIX + name)
+        raise
+    return True
@@ -0,0 +1,124 @@
+"""hints.py - The candidate engine behind get_hint.
+
+For each word length, a WordIndex holds bitsets over the word pool's words
+of that length, bit i standing for the i-th word: one per position and
+letter (the words with that letter there) and one per letter (the words
+containing it). Python's arbitrary-length integers are the bit vectors, so
+each AND filters every word at once. A game's candidates are the words with
+its revealed letters in place, no guessed letter at an unrevealed position
+and none of its wrong letters anywhere; the hint is the unguessed letter
+found in the most candidates, counted over the surviving set.
+
+Indexes are built on first use of each length. Hints are cached per
+(length, pattern, wrong letters) in an LRU; the pattern determines the
+correct letters. Both are dropped when the word pool is reloaded."""
+
+import binascii
+import threading
+
+from cache import LRUCache
+from models import ALPHABET, ORD_A, letter_bit
+import words
+
+HINT_CACHE_SIZE = 10000
+
+_lock = threading.Lock()
+_state = {'pool': None, 'indexes': {}}
+_hints = LRUCache(HINT_CACHE_SIZE)
+
+
+def _bits(buf):
+    """Returns the integer whose bit i is bit i of a little-endian
+    bytearray"""
+    if not buf:
+        return 0
+    return int(binascii.hexlify(bytes(buf[::-1])), 16)
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+class WordIndex(object):
+    """Position and letter bitsets over a WordPool's words of one length"""
+
+    def __init__(self, pool, length):
+        count = pool.count(length)
+        self.all = (1 << count) - 1
+        size = (count + 7) // 8
+        positions = [[bytearray(size) for _ in ALPHABET]
+                     for _ in range(length)]
+        for index in range(count):
+            byte, bit = index >> 3, 1 << (index & 7)
+            for position, letter in enumerate(pool.word(length, index)):
+                if letter_bit(letter):
+                    positions[position][ord(letter) - ORD_A][byte] |= bit
+        self.positions = [[_bits(buf) for buf in row] for row in positions]
+        self.letters = [0] * len(ALPHABET)
+        for row in self.positions:
+            for letter, bits in enumerate(row):
+                self.letters[letter] |= bits
+
+    def candidates(self, pattern, wrong_letters):
+        """Returns the bitset of the words matching pattern, the word with
+        unrevealed letters shown as '_', that contain none of the letters
+        in the wrong_letters bitset"""
+        candidates = self.all
+        correct = [ord(letter) - ORD_A for letter in set(pattern)
+                   if letter != '_']
+        for letter in range(len(ALPHABET)):
+            if wrong_letters >> letter & 1:
+                candidates &= ~self.letters[letter]
+        for position, letter in enumerate(pattern):
+            row = self.positions[position]
+            if letter == '_':
+                for guessed in correct:
+                    candidates &= ~row[guessed]
+            else:
+                candidates &= row[ord(letter) - ORD_A]
+        return candidates
+
+    def best_letter(self, pattern, wrong_letters):
+        """Returns (letter, candidates, matches): the unguessed letter in
+        the most candidate words (the first alphabetically on a tie, None if
+        there are no candidates), the number of candidates and the number
+        containing the letter"""
+        candidates = self.candidates(pattern, wrong_letters)
+        guessed = wrong_letters
+        for letter in pattern:
+            if letter != '_':
+                guessed |= letter_bit(letter)
+        best, matches = None, 0
+        for letter in range(len(ALPHABET)):
+            if guessed >> letter & 1:
+                continue
+            count = _popcount(candidates & self.letters[letter])
+            if count > matches:
+                best, matches = ALPHABET[letter], count
+        return best, _popcount(candidates), matches
+
+
+def _index(length):
+    pool = words.get_pool()
+    with _lock:
+        if _state['pool'] is not pool:
+            _state['pool'] = pool
+            _state['indexes'] = {}
+            _hints.clear()
+        index = _state['indexes'].get(length)
+        if index is None:
+            index = _state['indexes'][length] = WordIndex(pool, length)
+        return index
+
+
+def get_hint(game):
+    """Returns (letter, candidates, matches) for an unfinished Game; see
+    WordIndex.best_letter"""
+    pattern = game.revealed_word()
+    key = (game.word_length, pattern, game.wrong_letters)
+    index = _index(game.word_length)
+    hint = _hints.get(key)
+    if hint is None:
+        hint = index.best_letter(pattern, game.wrong_letters)
+        _hints.set(key, hint)
+    return hint
@@ -0,0 +1,230 @@
+"""leaderboard.py - The materialized high score tables.
+
+The LEADERBOARD_SIZE best winning Scores (fewest guesses, then earliest)
+are kept in one Leaderboard entity per period, mirrored in memcache, so
+get_high_scores and get_leaderboard read them without a query. There is an
+all-time table, and one bucket per day and per ISO week, named after the
+period they cover. Each winning Score is folded into the all-time table and
+the buckets of its day and week, in one transaction, if it qualifies for
+them; a finished game touches no table its Score does not qualify for. The
+request that commits the Score folds it in straight away, and a task queued
+in the same transaction repeats that in case the request dies first. If
+the all-time entity is lost it is rebuilt from Score with one bounded
+query, as are the current buckets after a bulk import (see bulk.py). A
+bucket with no entity has no winning Scores yet. Buckets carry the date
+after which they are no longer read, and expire_buckets deletes them once
+it has passed, so storage stays bounded."""
+
+import bisect
+import datetime
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import cache
+from models import Leaderboard, Score, ScoreForm, get_user_names
+
+LEADERBOARD_SIZE = 100
+LEADERBOARD_ID = 'all-time'
+MEMCACHE_PREFIX = 'leaderboard:'
+DAILY = 'daily'
+WEEKLY = 'weekly'
+ALL_TIME = LEADERBOARD_ID
+PERIODS = (DAILY, WEEKLY, ALL_TIME)
+# Days a bucket is kept after its period ends
+RETENTION_DAYS = 7
+EXPIRE_BATCH_SIZE = 500
+TASK_URL = '/tasks/add_score'
+
+
+def board_id(period, day):
+    """Returns the id of the Leaderboard of period that covers day"""
+    if period == DAILY:
+        return 'day:' + day.isoformat()
+    if period == WEEKLY:
+        year, week, _ = day.isocalendar()
+        return 'week:{}-W{:02d}'.format(year, week)
+    if period == ALL_TIME:
+        return LEADERBOARD_ID
+    raise ValueError('Unknown period')
+
+
+def _expires(period, day):
+    if period == DAILY:
+        last_day = day
+    else:
+        last_day = day + datetime.timedelta(days=7 - day.isoweekday())
+    return last_day + datetime.timedelta(days=RETENTION_DAYS)
+
+
+def get_entries(board=LEADERBOARD_ID):
+    """Returns the entries of the Leaderboard with id board, best first"""
+    cached = memcache.get(MEMCACHE_PREFIX + board)
+    if cached is not None:
+        return cached[1]
+    entity = Leaderboard.get_by_id(board)
+    if entity is None:
+        if board != LEADERBOARD_ID:
+            # Cache the empty bucket at version 0; its first put raises it.
+            cache.set_versioned(MEMCACHE_PREFIX + board, 0, [])
+            return []
+        return rebuild().entries
+    cache.set_versioned(MEMCACHE_PREFIX + board, entity.version,
+                        entity.entries)
+    return entity.entries
+
+
+def _forms(entries, number_of_records):
+    # Entries saved without a user name are skipped.
+    entries = [entry for entry in entries if entry[2]]
+    return [ScoreForm(user_name=user_name, date=date, won=True,
+                      guesses=guesses)
+            for guesses, date, user_name, score_id
+            in entries[:max(number_of_records, 0)]]
+
+
+def get_high_scores(number_of_records):
+    """Returns ScoreForms for the best number_of_records winning Scores"""
+    return _forms(get_entries(), number_of_records)
+
+
+def get_leaderboard(period, limit):
+    """Returns ScoreForms for the best limit winning Scores of the current
+    period: DAILY, WEEKLY or ALL_TIME. Raises ValueError for any other
+    period"""
+    return _forms(get_entries(board_id(period, datetime.date.today())), limit)
+
+
+def _qualifies(entries, guesses):
+    return len(entries) < LEADERBOARD_SIZE or guesses < entries[-1][0]
+
+
+def add_score(score, user_name):
+    """Adds a committed Score to the leaderboards it qualifies for"""
+    if not score.won:
+        return
+    entry = [score.guesses, str(score.date), user_name, score.key.id()]
+    boards = dict((board_id(period, score.date), period)
+                  for period in PERIODS)
+    cached = memcache.get_multi(boards.keys(), key_prefix=MEMCACHE_PREFIX)
+    for board, mirror in cached.items():
+        if not _qualifies(mirror[1], score.guesses):
+            del boards[board]
+    if not boards:
+        return
+
+    @ndb.transactional(xg=True)
+    def txn():
+        ids = sorted(boards)
+        entities = ndb.get_multi([ndb.Key(Leaderboard, board)
+                                  for board in ids])
+        changed = []
+        lost = False
+        for board, entity in zip(ids, entities):
+            if entity is None:
+                if board == LEADERBOARD_ID:
+                    lost = True
+                    continue
+                entity = Leaderboard(id=board, expires=_expires(
+                    boards[board], score.date))
+            entries = entity.entries
+            if (not _qualifies(entries, entry[0]) or
+                    entry[3] in [e[3] for e in entries]):
+                continue
+            index = bisect.bisect_right([e[:2] for e in entries], entry[:2])
+            entity.entries = (entries[:index] + [entry] +
+                              entries[index:])[:LEADERBOARD_SIZE]
+            changed.append(entity)
+        ndb.put_multi(changed)
+        return changed, lost
+
+    changed, lost = txn()
+    if lost:
+        # The Score is already committed, so the rebuild includes it.
+        rebuild()
+    for entity in changed:
+        cache.set_versioned(MEMCACHE_PREFIX + entity.key.id(),
+                            entity.version, entity.entries)
+
+
+def add_score_later_async(score):
+    """Queues a task that adds a winning Score to the leaderboards, so it
+    reaches them even if the request dies after committing it. Call it in
+    the transaction that saves the Score, after the put. Returns a Future,
+    or None for a lost game"""
+    if not score.won:
+        return None
+    return taskqueue.Queue().add_async(
+        taskqueue.Task(url=TASK_URL, params={'score': score.key.urlsafe()}),
+        transactional=True)
+
+
+def _entries(scores):
+    """Returns the entries of Scores, leaving out those whose User does not
+    exist"""
+    names = get_user_names(score.user for score in scores)
+    return [[score.guesses, str(score.date), names[score.user],
+             score.key.id()] for score in scores if score.user in names]
+
+
+def _save(board, entries, expires=None):
+    """Saves the entries of the Leaderboard with id board and publishes
+    them. Returns the entity"""
+    mirror = memcache.get(MEMCACHE_PREFIX + board)
+
+    @ndb.transactional
+    def txn():
+        # Update rather than replace the entity, and start a lost one past
+        # its mirror's version, so the version and the mirror keep moving
+        # forward.
+        entity = Leaderboard.get_by_id(board) or Leaderboard(
+            id=board, expires=expires,
+            version=mirror[0] if mirror else 0)
+        entity.entries = entries
+        entity.put()
+        return entity
+
+    entity = txn()
+    cache.set_versioned(MEMCACHE_PREFIX + board, entity.version,
+                        entity.entries)
+    return entity
+
+
+def rebuild():
+    """Recomputes the all-time leaderboard from Score and saves it"""
+    scores = Score.query(Score.won == True) \
+        .order(Score.guesses, Score.date).fetch(LEADERBOARD_SIZE)
+    return _save(LEADERBOARD_ID, _entries(scores))
+
+
+def rebuild_bucket(period, day):
+    """Recomputes the DAILY or WEEKLY Leaderboard covering day from Score
+    and saves it. A week is read as its days' best Scores"""
+    if period == DAILY:
+        days = [day]
+    elif period == WEEKLY:
+        monday = day - datetime.timedelta(days=day.weekday())
+        days = [monday + datetime.timedelta(days=n) for n in range(7)]
+    else:
+        raise ValueError('Unknown period')
+    futures = [Score.query(Score.won == True, Score.date == each)
+               .order(Score.guesses).fetch_async(LEADERBOARD_SIZE)
+               for each in days]
+    scores = sorted((score for future in futures
+                     for score in future.get_result()),
+                    key=lambda score: (score.guesses, score.date))
+    return _save(board_id(period, day), _entries(scores[:LEADERBOARD_SIZE]),
+                 _expires(period, day))
+
+
+def expire_buckets():
+    """Deletes one batch of buckets whose period ended more than
+    RETENTION_DAYS ago. Returns True if there may be more"""
+    keys = Leaderboard.query(
+        Leaderboard.expires < datetime.date.today()).fetch(
+            EXPIRE_BATCH_SIZE, keys_only=True)
+    ndb.delete_multi(keys)
+    memcache.delete_multi([key.id() for key in keys],
+                          key_prefix=MEMCACHE_PREFIX)
+    return len(keys) == EXPIRE_BATCH_SIZE
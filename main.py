@@ -5,28 +5,39 @@ cronjobs."""
 import logging
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import HangmanApi
-
-from models import User
+import accounts
+import archive
+import bulk
+import cache
+import counters
+import leaderboard
+import rankings
+import reminders
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        games = Game.query(Game.user.email is not None, game_over=False)
-        for game in games:
-            subject = 'This is a reminder!'
-            body = 'Hello {}, you still have a hangman game to play!' \
-                .format(user.name)
-            # This will send test emails, the arguments to send_mail are:
-            # from, to, subject, body
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           game.user.email,
-                           subject,
-                           body)
+        """Start the run that sends a reminder email to each User with an
+        email about their active games. Called every day using a cron job"""
+        reminders.start_run()
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send the reminders for one batch of active games."""
+        skip_user = self.request.get('skip_user')
+        reminders.send_batch(
+            self.request.get('run'),
+            int(self.request.get('batch')),
+            self.request.get('cursor') or None,
+            ndb.Key(urlsafe=skip_user) if skip_user else None,
+            int(self.request.get('games', 0)),
+            int(self.request.get('users', 0)))
+        self.response.set_status(204)
 
 
 class UpdateAverageMovesRemaining(webapp2.RequestHandler):
@@ -36,7 +47,137 @@ class UpdateAverageMovesRemaining(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class RebuildRankings(webapp2.RequestHandler):
+    def post(self):
+        """Recompute the Users' ranking aggregates from their Scores, one
+        batch per task: the Users given, or else every User."""
+        users = self.request.get_all('user')
+        if users:
+            rankings.rebuild_users([ndb.Key(urlsafe=user) for user in users])
+            self.response.set_status(204)
+            return
+        cursor = self.request.get('cursor')
+        next_cursor = rankings.rebuild_batch(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/rebuild_rankings',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class MigrateUsers(webapp2.RequestHandler):
+    def post(self):
+        """Move Users with numeric ids to name keys, one batch per task."""
+        cursor = self.request.get('cursor')
+        next_cursor = accounts.migrate_batch(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/migrate_users',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class RebuildCounters(webapp2.RequestHandler):
+    def post(self):
+        """Recount the game counters from the Games."""
+        counters.rebuild()
+        self.response.set_status(204)
+
+
+class AddScore(webapp2.RequestHandler):
+    def post(self):
+        """Add a winning Score to the leaderboards, in case the request that
+        saved it did not."""
+        score = ndb.Key(urlsafe=self.request.get('score')).get()
+        if score:
+            leaderboard.add_score(score, cache.get_user_name(score.user))
+        self.response.set_status(204)
+
+
+class PublishEntity(webapp2.RequestHandler):
+    def post(self):
+        """Publish a written entity to the read cache, in case the request
+        that wrote it did not."""
+        entity = ndb.Key(urlsafe=self.request.get('key')).get()
+        if entity:
+            cache.publish(entity)
+        self.response.set_status(204)
+
+
+class ExpireLeaderboards(webapp2.RequestHandler):
+    def get(self):
+        """Delete the daily and weekly leaderboards that are no longer
+        read. Called every day using a cron job"""
+        while leaderboard.expire_buckets():
+            pass
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Start archiving the Games that ended long ago. Called every day
+        using a cron job"""
+        taskqueue.add(url='/tasks/archive_games')
+
+    def post(self):
+        """Archive one batch of Games, then hand the rest to the next
+        task."""
+        if archive.archive_batch():
+            taskqueue.add(url='/tasks/archive_games')
+        self.response.set_status(204)
+
+
+class StampEndedGames(webapp2.RequestHandler):
+    def post(self):
+        """Date the ended Games stored before Games recorded when they
+        ended, one batch per task."""
+        cursor = self.request.get('cursor')
+        next_cursor = archive.stamp_batch(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/stamp_ended_games',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class QueueImportChunks(webapp2.RequestHandler):
+    def post(self):
+        """Queue the tasks that write one part of a bulk import."""
+        bulk.queue_chunks(int(self.request.get('job')),
+                          int(self.request.get('first')),
+                          int(self.request.get('count')))
+        self.response.set_status(204)
+
+
+class ImportChunk(webapp2.RequestHandler):
+    def post(self):
+        """Write one chunk of a bulk import's records."""
+        bulk.write_chunk(int(self.request.get('job')),
+                         int(self.request.get('chunk')))
+        self.response.set_status(204)
+
+
+class FinishImport(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild the counters, leaderboards and rankings once a bulk
+        import is written."""
+        bulk.finish(int(self.request.get('job')))
+        self.response.set_status(204)
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/expire_leaderboards', ExpireLeaderboards),
+    ('/crons/archive_games', ArchiveGames),
+    ('/tasks/archive_games', ArchiveGames),
+    ('/tasks/stamp_ended_games', StampEndedGames),
+    ('/tasks/send_reminders', SendReminderBatch),
     ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/rebuild_rankings', RebuildRankings),
+    ('/tasks/rebuild_counters', RebuildCounters),
+    ('/tasks/add_score', AddScore),
+    ('/tasks/publish', PublishEntity),
+    ('/tasks/migrate_users', MigrateUsers),
+    ('/tasks/import_part', QueueImportChunks),
+    ('/tasks/import_chunk', ImportChunk),
+    ('/tasks/import_finish', FinishImport),
 ], debug=True)
@@ -2,25 +2,60 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
-import urllib
-import random
 from datetime import date
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import words
+
+
+ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+ORD_A = ord('A')
+ATTEMPTS_ALLOWED = 6
+
+
+def letter_bit(letter):
+    """Returns the bitset bit of a single letter A-Z, or 0 for anything else"""
+    if len(letter) != 1 or not 'A' <= letter <= 'Z':
+        return 0
+    return 1 << (ord(letter) - ORD_A)
+
+
+def letters_to_bits(letters):
+    """Returns the bitset of a sequence of letters"""
+    bits = 0
+    for letter in letters:
+        bits |= letter_bit(letter)
+    return bits
+
 
 class User(ndb.Model):
     """User profile"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
-    ranking = ndb.IntegerProperty(default=None)
+    games_played = ndb.IntegerProperty(default=0)
+    total_guesses = ndb.IntegerProperty(default=0)
+    average_guesses = ndb.FloatProperty()
 
-    def to_form(self):
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of the User with the given name. Users created
+        before Users were keyed by name have numeric ids until migrated
+        (see accounts.migrate_batch)"""
+        return ndb.Key(cls, name)
+
+    def add_score(self, guesses):
+        """Folds a finished game into the User's ranking aggregates"""
+        self.games_played += 1
+        self.total_guesses += guesses
+        self.average_guesses = float(self.total_guesses) / self.games_played
+
+    def to_form(self, ranking):
         """Returns a UserForm representation of the User"""
         form = UserForm()
         form.urlsafe_key = self.key.urlsafe()
         form.user_name = self.name
-        form.ranking = self.ranking
+        form.ranking = ranking
         return form
 
 
@@ -34,10 +69,15 @@ class UserForm(messages.Message):
 class UserForms(messages.Message):
     """Return multiple UserForms"""
     rankings = messages.MessageField(UserForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class Game(ndb.Model):
     """Game object"""
+    # Games are cached by cache.py, keyed on version; skip ndb's own
+    # memcache layer.
+    _use_memcache = False
+
     word_length = ndb.IntegerProperty(required=True)
     word = ndb.StringProperty(required=True)
     attempts_allowed = ndb.IntegerProperty(required=True)
@@ -47,59 +87,167 @@ class Game(ndb.Model):
     letters_guessed_wrong = ndb.StringProperty(repeated=True)
     user = ndb.KeyProperty(required=True, kind='User')
     cancelled = ndb.BooleanProperty(required=True, default=False)
+    # When the game finished or was cancelled. Ended Games are moved to the
+    # archive (see archive.py) some days later.
+    ended = ndb.DateProperty()
+    # Bitsets over A-Z (bit 0 is A) and, per letter, a bitmask of the
+    # positions it occupies in the word. See index_word.
+    word_letters = ndb.IntegerProperty(indexed=False)
+    letter_positions = ndb.IntegerProperty(repeated=True, indexed=False)
+    correct_letters = ndb.IntegerProperty(default=0, indexed=False)
+    wrong_letters = ndb.IntegerProperty(default=0, indexed=False)
+    # Bumped by every put, so cached copies can be checked for staleness.
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+    def _pre_put_hook(self):
+        self.version += 1
+
+    def index_word(self):
+        """Precomputes the bitsets guesses are evaluated against. Games
+        stored before the bitsets existed are indexed on first use"""
+        positions = [0] * len(ALPHABET)
+        for index, letter in enumerate(self.word):
+            if letter_bit(letter):
+                positions[ord(letter) - ORD_A] |= 1 << index
+        self.letter_positions = positions
+        self.word_letters = letters_to_bits(
+            letter for letter in ALPHABET if positions[ord(letter) - ORD_A])
+        self.correct_letters = letters_to_bits(self.letters_guessed_correct)
+        self.wrong_letters = letters_to_bits(self.letters_guessed_wrong)
+
+    def _ensure_indexed(self):
+        if self.word_letters is None:
+            self.index_word()
+
+    def letter_matches(self, letter):
+        """Returns how many times a letter appears in the word"""
+        self._ensure_indexed()
+        return bin(self.letter_positions[ord(letter) - ORD_A]).count('1')
+
+    def has_guessed(self, letter):
+        """Returns True if the letter has already been guessed"""
+        self._ensure_indexed()
+        return bool((self.correct_letters | self.wrong_letters) &
+                    letter_bit(letter))
+
+    def is_solved(self):
+        """Returns True once every letter in the word has been guessed"""
+        self._ensure_indexed()
+        return self.correct_letters == self.word_letters
+
+    def revealed_word(self):
+        """Returns the word with letters not yet guessed shown as '_'"""
+        self._ensure_indexed()
+        revealed = 0
+        for index, positions in enumerate(self.letter_positions):
+            if self.correct_letters >> index & 1:
+                revealed |= positions
+        return ''.join(letter if revealed >> index & 1 else '_'
+                       for index, letter in enumerate(self.word))
 
     def add_correct_guess(self, value):
         """Adds the guess to letters_guessed_correct"""
+        self._ensure_indexed()
         self.letters_guessed_correct.append(value)
-        self.put()
+        self.correct_letters |= letter_bit(value)
 
     def add_wrong_guess(self, value):
         """Adds the guess to letters_guessed_wrong"""
+        self._ensure_indexed()
         self.letters_guessed_wrong.append(value)
-        self.put()
+        self.wrong_letters |= letter_bit(value)
 
     def cancel_game(self):
         self.cancelled = True
-        self.put()
+        self.ended = date.today()
 
     @classmethod
-    def new_game(cls, user, word_length):
-        """Creates and returns a new game"""
-        if word_length < 10 or word_length > 20:
+    def new_game(cls, user, word_length, word=None, id=None):
+        """Creates and returns a new game of word, by default a random word
+        of word_length; the caller saves it"""
+        if (word_length < words.MIN_WORD_LENGTH or
+                word_length > words.MAX_WORD_LENGTH):
             raise ValueError('Word must be between 10 and 20.')
-        random_word_url = "http://randomword.setgetgo.com/get.php?len=" + \
-            str(word_length)
-        word = urllib.urlopen(random_word_url).read().upper()
-        game = Game(user=user,
+        if word is None:
+            word = words.random_word(word_length)
+        game = Game(id=id,
+                    user=user,
                     word=word,
                     word_length=word_length,
-                    attempts_allowed=6,
-                    attempts_remaining=6,
+                    attempts_allowed=ATTEMPTS_ALLOWED,
+                    attempts_remaining=ATTEMPTS_ALLOWED,
                     game_over=False)
-        game.put()
+        game.index_word()
         return game
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def to_form(self, message, user_name=None):
+        """Returns a GameForm representation of the Game. Looks the User up
+        unless user_name is given"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user.get().name
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
         form.cancelled = self.cancelled
+        form.revealed_word = self.revealed_word()
         if message:
             form.message = message
         return form
 
+    @classmethod
+    def summary_query(cls, user_key):
+        """Returns a projection query of a User's Games that reads only the
+        fields of a GameSummaryForm"""
+        return cls.query(cls.user == user_key,
+                         projection=[cls.game_over, cls.cancelled,
+                                     cls.attempts_remaining])
+
+    @classmethod
+    @ndb.tasklet
+    def count_for_user_async(cls, user_key):
+        """Returns a Future of a User's numbers of active, finished and
+        cancelled Games, counted with keys-only queries run in parallel"""
+        counts = yield (
+            cls.query(cls.user == user_key, cls.game_over == False,
+                      cls.cancelled == False).count_async(),
+            cls.query(cls.user == user_key,
+                      cls.game_over == True).count_async(),
+            cls.query(cls.user == user_key,
+                      cls.cancelled == True).count_async())
+        raise ndb.Return(counts)
+
+    def to_summary_form(self):
+        """Returns a GameSummaryForm of the Game. Works on the partial Games
+        summary_query returns"""
+        return GameSummaryForm(urlsafe_key=self.key.urlsafe(),
+                               attempts_remaining=self.attempts_remaining,
+                               game_over=self.game_over,
+                               cancelled=self.cancelled)
+
     def end_game(self, won=False):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost. Returns the game's Score; the caller saves it along
+        with the Game."""
         self.game_over = True
-        self.put()
+        self.ended = date.today()
         # Add the game to the score 'board'
-        score = Score(user=self.user, date=date.today(), won=won,
-                      guesses=self.attempts_allowed - self.attempts_remaining)
-        score.put()
+        return Score(user=self.user, date=date.today(), won=won,
+                     guesses=self.attempts_allowed - self.attempts_remaining)
+
+
+def get_user_names(user_keys):
+    """Returns a dict mapping User keys to names, fetching each distinct User
+    once in a single multi-get"""
+    return get_user_names_async(user_keys).get_result()
+
+
+@ndb.tasklet
+def get_user_names_async(user_keys):
+    """Asynchronous get_user_names"""
+    keys = list(set(user_keys))
+    users = yield ndb.get_multi_async(keys)
+    raise ndb.Return(dict((key, user.name)
+                          for key, user in zip(keys, users) if user))
 
 
 class GameForm(messages.Message):
@@ -110,11 +258,39 @@ class GameForm(messages.Message):
     message = messages.StringField(4, required=False)
     user_name = messages.StringField(5, required=True)
     cancelled = messages.BooleanField(6, required=False)
+    revealed_word = messages.StringField(7)
 
 
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     games = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class HintForm(messages.Message):
+    """The letter most likely to be in a game's word, out of the candidate
+    words that fit the game so far"""
+    letter = messages.StringField(1)
+    candidates = messages.IntegerField(2, required=True)
+    probability = messages.FloatField(3)
+
+
+class GameSummaryForm(messages.Message):
+    """Compact GameForm for game listings"""
+    urlsafe_key = messages.StringField(1, required=True)
+    attempts_remaining = messages.IntegerField(2, required=True)
+    game_over = messages.BooleanField(3, required=True)
+    cancelled = messages.BooleanField(4, required=True)
+
+
+class GameSummaryForms(messages.Message):
+    """A User's game counts and one page of their GameSummaryForms"""
+    user_name = messages.StringField(1, required=True)
+    active = messages.IntegerField(2, required=True)
+    finished = messages.IntegerField(3, required=True)
+    cancelled = messages.IntegerField(4, required=True)
+    games = messages.MessageField(GameSummaryForm, 5, repeated=True)
+    next_cursor = messages.StringField(6)
 
 
 class NewGameForm(messages.Message):
@@ -128,6 +304,23 @@ class MakeMoveForm(messages.Message):
     guess = messages.StringField(1, required=True)
 
 
+class MakeMovesForm(messages.Message):
+    """Used to make several moves in an existing game at once"""
+    guesses = messages.StringField(1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """The outcome of one guess of a make_moves request"""
+    guess = messages.StringField(1, required=True)
+    message = messages.StringField(2, required=True)
+
+
+class MovesForm(messages.Message):
+    """Return the final game state and the outcome of each guess applied"""
+    game = messages.MessageField(GameForm, 1, required=True)
+    results = messages.MessageField(MoveResultForm, 2, repeated=True)
+
+
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
@@ -135,9 +328,90 @@ class Score(ndb.Model):
     won = ndb.BooleanProperty(required=True)
     guesses = ndb.IntegerProperty(required=True)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
-                         date=str(self.date), guesses=self.guesses)
+    def to_form(self, user_name=None):
+        """Returns a ScoreForm representation of the Score. Looks the User up
+        unless user_name is given"""
+        return ScoreForm(user_name=user_name or self.user.get().name,
+                         won=self.won, date=str(self.date),
+                         guesses=self.guesses)
+
+    @classmethod
+    def to_forms(cls, scores, next_cursor=None):
+        """Returns ScoreForms for scores, fetching their Users in one batch.
+        Scores whose User does not exist are left out"""
+        names = get_user_names(score.user for score in scores)
+        return ScoreForms(items=[score.to_form(names[score.user])
+                                 for score in scores if score.user in names],
+                          next_cursor=next_cursor)
+
+
+class GameArchive(ndb.Model):
+    """A batch of a User's archived Games, oldest first, as [urlsafe key,
+    result, guesses, date, word length] entries. A child of the User,
+    numbered from 1. Maintained by archive.py"""
+    entries = ndb.JsonProperty(default=[])
+    # Totals over this batch and every earlier one
+    finished = ndb.IntegerProperty(default=0, indexed=False)
+    cancelled = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class CounterShard(ndb.Model):
+    """One shard of a named counter. Maintained by counters.py"""
+    name = ndb.StringProperty(required=True)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class Leaderboard(ndb.Model):
+    """The best winning Scores of a period, best first, as [guesses, date,
+    user_name, score id] entries. Maintained by leaderboard.py"""
+    # Mirrored in memcache by leaderboard.py.
+    _use_memcache = False
+    entries = ndb.JsonProperty(default=[])
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # When a daily or weekly bucket can be deleted; None for all-time.
+    expires = ndb.DateProperty()
+
+    def _pre_put_hook(self):
+        self.version += 1
+
+
+class Migration(ndb.Model):
+    """Marks a completed data migration, keyed by its name"""
+    completed = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ImportJob(ndb.Model):
+    """A bulk import of Users, Games and Scores. Maintained by bulk.py"""
+    # Chunks queued so far; the ones written are counted by a sharded
+    # counter (see bulk.py).
+    chunks = ndb.IntegerProperty(default=0, indexed=False)
+    records = ndb.IntegerProperty(default=0, indexed=False)
+    # Set by the request carrying the last records; no more can be added.
+    sealed = ndb.BooleanProperty(default=False, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty()
+
+
+class ImportChunk(ndb.Model):
+    """Records of an ImportJob waiting to be written, as [kind, record]
+    pairs. A child of the ImportJob, numbered from 0. Maintained by
+    bulk.py"""
+    records = ndb.JsonProperty()
+
+
+class ImportChunkDone(ndb.Model):
+    """Marks one chunk of an ImportJob as written. A root entity, keyed by
+    '<job id>-<chunk>', so that marking chunks done does not contend on the
+    ImportJob. Maintained by bulk.py"""
+    written = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class ImportUsers(ndb.Model):
+    """The names of the Users one part of an ImportJob imports, and the keys
+    of every User its records touch. A child of the ImportJob. Maintained by
+    bulk.py"""
+    names = ndb.StringProperty(repeated=True, indexed=False)
+    keys = ndb.KeyProperty(repeated=True, indexed=False)
 
 
 class ScoreForm(messages.Message):
@@ -151,6 +425,75 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class RpcCountForm(messages.Message):
+    """A count of one kind of RPC, or of what those RPCs carried"""
+    name = messages.StringField(1, required=True)
+    count = messages.IntegerField(2, required=True)
+
+
+class EndpointStatsForm(messages.Message):
+    """Calls, latency and RPCs of one endpoint method"""
+    name = messages.StringField(1, required=True)
+    calls = messages.IntegerField(2, required=True)
+    errors = messages.IntegerField(3, required=True)
+    mean_ms = messages.FloatField(4)
+    p50_ms = messages.FloatField(5)
+    p99_ms = messages.FloatField(6)
+    max_ms = messages.FloatField(7)
+    counts = messages.MessageField(RpcCountForm, 8, repeated=True)
+
+
+class StatsForm(messages.Message):
+    """Per-endpoint statistics over the last minutes"""
+    minutes = messages.IntegerField(1, required=True)
+    endpoints = messages.MessageField(EndpointStatsForm, 2, repeated=True)
+
+
+class UserRecordForm(messages.Message):
+    """A User to import"""
+    name = messages.StringField(1, required=True)
+    email = messages.StringField(2)
+
+
+class GameRecordForm(messages.Message):
+    """A Game to import: its word, or a random word of word_length, with
+    guesses replayed in order. A game the guesses finish gets its Score"""
+    user_name = messages.StringField(1, required=True)
+    word = messages.StringField(2)
+    word_length = messages.IntegerField(3, default=10)
+    guesses = messages.StringField(4, repeated=True)
+    cancelled = messages.BooleanField(5, default=False)
+
+
+class ScoreRecordForm(messages.Message):
+    """A Score to import; date is YYYY-MM-DD"""
+    user_name = messages.StringField(1, required=True)
+    date = messages.StringField(2, required=True)
+    won = messages.BooleanField(3, required=True)
+    guesses = messages.IntegerField(4, required=True)
+
+
+class ImportForm(messages.Message):
+    """One part of a bulk import. The first part starts a job; later parts
+    name it, and the final one seals it"""
+    job_id = messages.IntegerField(1)
+    users = messages.MessageField(UserRecordForm, 2, repeated=True)
+    games = messages.MessageField(GameRecordForm, 3, repeated=True)
+    scores = messages.MessageField(ScoreRecordForm, 4, repeated=True)
+    final = messages.BooleanField(5, default=True)
+
+
+class ImportJobForm(messages.Message):
+    """The state of a bulk import"""
+    job_id = messages.IntegerField(1, required=True)
+    records = messages.IntegerField(2, required=True)
+    chunks = messages.IntegerField(3, required=True)
+    done = messages.IntegerField(4, required=True)
+    sealed = messages.BooleanField(5, required=True)
+    finished = messages.StringField(6)
 
 
 class StringMessage(messages.Message):
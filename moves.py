@@ -0,0 +1,182 @@
+"""moves.py - The game logic behind new_game, make_move and cancel_game.
+
+A guess is applied to the Game in memory, then everything it changed is
+written with a single put_multi inside one cross-group transaction: the
+Game, plus the Score, the player's ranking aggregates and the game counter
+shards (see counters.py) when the guess ends the game. The Game is read
+inside the transaction, so concurrent moves on one game are serialized by
+the datastore's optimistic concurrency: a move whose Game changed before it
+committed is retried against the new state instead of overwriting it. After
+the commit, the Game is published to the read cache, the cached counter
+totals are adjusted and a winning Score is offered to the leaderboard, all
+at once; tasks queued in the transaction publish the Game and offer the
+Score again, in case the request dies before it does. make_moves applies a
+whole sequence of guesses the same way, with one read and one commit.
+
+Independent reads are started together as tasklets, so a request waits for
+its longest chain of RPCs rather than for each RPC in turn."""
+
+from google.appengine.ext import ndb
+
+import cache
+import counters
+import leaderboard
+from models import ALPHABET, Game, letter_bit
+
+GAME_FINISHED = {counters.ACTIVE_GAMES: -1, counters.FINISHED_GAMES: 1}
+GAME_CANCELLED = {counters.ACTIVE_GAMES: -1, counters.CANCELLED_GAMES: 1}
+# Enough to guess every letter once
+MAX_GUESSES = len(ALPHABET)
+
+
+def apply_guess(game, guess):
+    """Applies one guess to the Game in memory; nothing is written.
+    Returns (message, changed, won): changed is True if the Game must be
+    saved, and won is True or False when the guess ended the game and None
+    otherwise"""
+    if game.game_over:
+        return 'Game already over!', False, None
+
+    if game.cancelled:
+        return 'This game was cancelled!', False, None
+
+    if len(guess) > 1:
+        return 'Invalid guess! You can only guess \
+                                one letter at a time!', False, None
+
+    if not letter_bit(guess):
+        return 'You need to enter a letter (A-Z)!', False, None
+
+    number_matched = game.letter_matches(guess)
+
+    if game.has_guessed(guess) and number_matched > 0:
+        return "You've already guessed " + guess + \
+            ", which is a correct letter.", False, None
+
+    if game.has_guessed(guess):
+        return "You've already guessed " + guess + \
+            ", which is an incorrect letter.", False, None
+
+    if number_matched > 0:
+        game.add_correct_guess(guess)
+        if game.is_solved():
+            return 'You win!', True, True
+        if number_matched > 1:
+            return "You guessed correct. There are " + \
+                str(number_matched) + " " + guess + "'s", True, None
+        return "You guessed correct. There is " + \
+            str(number_matched) + " " + guess + "'s", True, None
+
+    game.attempts_remaining -= 1
+    game.add_wrong_guess(guess)
+    msg = "Wrong! There are no " + guess + "'s" + " in this word."
+    if game.attempts_remaining < 1:
+        return msg + ' Game over!', True, False
+    return msg, True, None
+
+
+def start_game(user_key, word_length):
+    """Creates a Game and counts it in one transaction. Returns the Game"""
+    deltas = {counters.ACTIVE_GAMES: 1,
+              counters.games_of_length(word_length): 1}
+
+    def txn():
+        game = Game.new_game(user_key, word_length)
+        ndb.put_multi([game] + counters.prepare(deltas))
+        return game
+    game = ndb.transaction(txn, xg=True)
+    counters.update_cache(deltas)
+    return game
+
+
+@ndb.tasklet
+def finish_game_async(game, won):
+    """Ends the Game in memory. Returns a Future of its Score and the
+    player's User, which the caller saves with the Game"""
+    score = game.end_game(won)
+    user = yield game.user.get_async()
+    user.add_score(score.guesses)
+    raise ndb.Return((score, user))
+
+
+def make_move(game_key, guess):
+    """Applies a guess and commits its effects in one transaction.
+    Returns (game, message), or (None, None) if there is no such Game"""
+    game, results = make_moves(game_key, [guess])
+    if game is None:
+        return None, None
+    return game, results[0][1]
+
+
+def make_moves(game_key, guesses):
+    """Applies guesses in order, stopping once the game is over, and commits
+    their effects in one transaction. Returns the Game and a (guess,
+    message) pair for each guess applied, or (None, None) if there is no
+    such Game"""
+    if len(guesses) > MAX_GUESSES:
+        raise ValueError('Too many guesses')
+
+    @ndb.tasklet
+    def txn():
+        game = yield game_key.get_async()
+        if game is None:
+            raise ndb.Return((None, None, False, None))
+        results = []
+        changed = False
+        won = None
+        for guess in guesses:
+            message, guess_changed, won = apply_guess(game, guess)
+            results.append((guess, message))
+            changed = changed or guess_changed
+            if game.game_over or game.cancelled or won is not None:
+                break
+        result = None
+        if changed:
+            entities = [game]
+            if won is not None:
+                # The player and the counter shard are read in parallel.
+                result, shards = yield (finish_game_async(game, won),
+                                        counters.prepare_async(GAME_FINISHED))
+                entities.extend(result)
+                entities.extend(shards)
+            yield (ndb.put_multi_async(entities),
+                   cache.publish_later_async(game))
+            if result:
+                queued = leaderboard.add_score_later_async(result[0])
+                if queued:
+                    yield queued
+        raise ndb.Return((game, results, changed, result))
+    game, results, changed, result = ndb.transaction(txn, xg=True)
+    rpcs = []
+    if changed:
+        rpcs.append(cache.publish_async(game))
+    if result:
+        rpcs.append(counters.update_cache_async(GAME_FINISHED))
+        score, user = result
+        leaderboard.add_score(score, user.name)
+    for rpc in rpcs:
+        rpc.get_result()
+    return game, results
+
+
+def cancel_game(game_key):
+    """Cancels an unfinished Game in a transaction. Returns the Game, or
+    None if there is no such Game"""
+    @ndb.tasklet
+    def txn():
+        game, shards = yield (game_key.get_async(),
+                              counters.prepare_async(GAME_CANCELLED))
+        changed = (game is not None and not game.game_over and
+                   not game.cancelled)
+        if changed:
+            game.cancel_game()
+            yield (ndb.put_multi_async([game] + shards),
+                   cache.publish_later_async(game))
+        raise ndb.Return((game, changed))
+    game, changed = ndb.transaction(txn, xg=True)
+    if changed:
+        rpcs = [cache.publish_async(game),
+                counters.update_cache_async(GAME_CANCELLED)]
+        for rpc in rpcs:
+            rpc.get_result()
+    return game
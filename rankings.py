@@ -0,0 +1,101 @@
+"""rankings.py - Player rankings.
+
+Every User keeps running totals of the games they have finished and the
+guesses those games took (see User.add_score). Players are ranked by their
+average guesses per game, fewest first. The datastore index on
+User.average_guesses is the ordered rank structure: finishing a game
+rewrites only the player who finished it, and reading the rankings is one
+ordered query with no Score scan."""
+
+import logging
+
+import endpoints
+from google.appengine.ext import ndb
+
+from models import User, Score
+from utils import fetch_page
+
+REBUILD_BATCH_SIZE = 100
+REBUILD_RETRIES = 3
+
+
+def ranked_page(page_size, cursor=None):
+    """Returns one page of (ranking, User) pairs, best player first, and the
+    cursor of the next page (None on the last page). Users who have not
+    finished a game yet are not ranked. A cursor is the ranking its page
+    starts after, a '.', and the datastore cursor, so every page numbers its
+    players without counting the ones before it."""
+    offset = 0
+    if cursor:
+        offset, _, cursor = cursor.partition('.')
+        if not offset.isdigit() or not cursor:
+            raise endpoints.BadRequestException('Invalid cursor')
+        offset = int(offset)
+    query = User.query(User.average_guesses >= 0).order(User.average_guesses)
+    users, next_cursor = fetch_page(query, page_size, cursor)
+    if next_cursor:
+        next_cursor = '{}.{}'.format(offset + len(users), next_cursor)
+    return ([(offset + index + 1, user) for index, user in enumerate(users)],
+            next_cursor)
+
+
+def rebuild_batch(cursor=None):
+    """Recomputes the ranking aggregates of one batch of Users from their
+    Scores, as for Users created before the aggregates existed. Returns the
+    cursor of the next batch, or None when done"""
+    users, next_cursor, more = User.query().fetch_page(
+        REBUILD_BATCH_SIZE, start_cursor=cursor)
+    _rebuild_all(users)
+    return next_cursor if more else None
+
+
+def rebuild_users(user_keys):
+    """Recomputes the ranking aggregates of the Users with the given keys,
+    at most REBUILD_BATCH_SIZE of them, from their Scores, as for the Users
+    a bulk import touched"""
+    _rebuild_all([user for user in ndb.get_multi(user_keys) if user])
+
+
+def _rebuild_all(users):
+    futures = [Score.query(Score.user == user.key).fetch_async()
+               for user in users]
+    for user, future in zip(users, futures):
+        _rebuild(user, future.get_result())
+
+
+def _totals(user):
+    return user.games_played, user.total_guesses
+
+
+def _rebuild(user, scores):
+    """Saves a User's aggregates recomputed from scores, which were read
+    after the User. The User is re-read in a transaction; if one of their
+    games ended since it was read, its Scores are read again"""
+    seen = _totals(user)
+    for _ in range(REBUILD_RETRIES):
+        @ndb.transactional
+        def txn():
+            current = user.key.get()
+            if current is None or _totals(current) != seen:
+                return current
+            recompute(current, scores)
+            current.put()
+            return None
+        current = txn()
+        if current is None:
+            return
+        seen = _totals(current)
+        scores = Score.query(Score.user == user.key).fetch()
+    logging.warning('Could not rebuild the rankings of %s', user.name)
+
+
+def recompute(user, scores=None):
+    """Recomputes a User's ranking aggregates, in memory, from scores or by
+    default from the User's Scores"""
+    if scores is None:
+        scores = Score.query(Score.user == user.key)
+    user.games_played = 0
+    user.total_guesses = 0
+    user.average_guesses = None
+    for score in scores:
+        user.add_score(score.guesses)
@@ -0,0 +1,85 @@
+"""reminders.py - The reminder email pipeline behind the send_reminder cron.
+
+The cron only starts a run. Each task of the run reads one batch of active
+Games, hands the rest of the scan to the next task and then emails the
+players of its batch, so no request has to cover every Game and a failed
+batch is retried on its own. Games are scanned in User order, so each
+player's Games are contiguous and each player gets one email per run: a
+batch that ends part-way through a player's Games tells the next batch to
+skip them. Tasks are named after the run and batch number, so a retried
+batch cannot start a second copy of the rest of the run."""
+
+import datetime
+import logging
+import time
+
+from google.appengine.api import app_identity, mail, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Game
+
+BATCH_SIZE = 100
+TASK_URL = '/tasks/send_reminders'
+SUBJECT = 'This is a reminder!'
+BODY = 'Hello {}, you still have a hangman game to play!'
+
+
+def start_run():
+    """Starts today's reminder run, unless it has already been started"""
+    _enqueue(datetime.date.today().isoformat(), 0)
+
+
+def _enqueue(run, batch, cursor=None, skip_user=None, games=0, users=0):
+    params = {'run': run, 'batch': batch, 'games': games, 'users': users}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    if skip_user:
+        params['skip_user'] = skip_user.urlsafe()
+    try:
+        taskqueue.add(url=TASK_URL, params=params,
+                      name='reminders-{}-{}'.format(run, batch))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Reminder run %s batch %d already enqueued', run, batch)
+
+
+def active_games_query():
+    """Returns the query for the Users of active Games, in User order"""
+    return Game.query(Game.game_over == False, Game.cancelled == False,
+                      projection=[Game.user]).order(Game.user)
+
+
+def send_batch(run, batch, cursor=None, skip_user=None, games=0, users=0):
+    """Sends the reminders for one batch of active Games and enqueues the
+    next batch. games and users are the run's totals so far"""
+    start = time.time()
+    page, next_cursor, more = active_games_query().fetch_page(
+        BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    user_keys = []
+    for game in page:
+        if game.user != skip_user and game.user not in user_keys[-1:]:
+            user_keys.append(game.user)
+    if more:
+        # The last player may have more Games in the next batch; this batch
+        # reminds them, so the next one must not.
+        _enqueue(run, batch + 1, next_cursor, page[-1].user,
+                 games + len(page), users + len(user_keys))
+
+    sender = 'noreply@{}.appspotmail.com'.format(
+        app_identity.get_application_id())
+    sent = 0
+    for user in ndb.get_multi(user_keys):
+        if user is not None and user.email:
+            mail.send_mail(sender, user.email, SUBJECT,
+                           BODY.format(user.name))
+            sent += 1
+
+    elapsed = time.time() - start
+    logging.info('Reminder run %s batch %d: %d games, %d users, %d emails '
+                 'in %.2fs (%.1f games/s)', run, batch, len(page),
+                 len(user_keys), sent, elapsed,
+                 len(page) / elapsed if elapsed else 0.0)
+    if not more:
+        logging.info('Reminder run %s done: %d games, %d users in %d '
+                     'batches', run, games + len(page),
+                     users + len(user_keys), batch + 1)
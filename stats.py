@@ -0,0 +1,191 @@
+"""stats.py - Per-endpoint call, latency and RPC statistics.
+
+Endpoint methods decorated with instrument() record their calls, errors and
+latency. An apiproxy hook charges every RPC made while one runs to it:
+datastore gets, puts, deletes and queries (with the keys, entities and
+results they carried), memcache gets (with hits and misses) and any other
+service; code can add counts of its own with count(). The counts are kept
+in a per-instance registry, which costs a dict update per RPC, and added to
+memcache at most every FLUSH_INTERVAL seconds, into one entry per minute.
+get_stats sums the entries of the last minutes, across instances."""
+
+import bisect
+import collections
+import functools
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+from models import StatsForm, EndpointStatsForm, RpcCountForm
+
+FLUSH_INTERVAL = 60
+WINDOW_MINUTES = 60
+FLUSH_RETRIES = 3
+MEMCACHE_PREFIX = 'stats:'
+MEMCACHE_TIME = (WINDOW_MINUTES + 5) * 60
+# Upper bounds, in milliseconds, of the latency histogram's buckets. A last
+# bucket holds the calls slower than all of them.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_local = threading.local()
+_lock = threading.Lock()
+_registry = {}
+_last_flush = [time.time()]
+
+
+def _new_entry():
+    return {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            'counts': collections.Counter()}
+
+
+def _merge(into, entries):
+    """Adds entries, a dict of endpoint name -> entry, to into"""
+    for name, entry in entries.items():
+        total = into.setdefault(name, _new_entry())
+        total['calls'] += entry['calls']
+        total['errors'] += entry['errors']
+        total['total_ms'] += entry['total_ms']
+        total['max_ms'] = max(total['max_ms'], entry['max_ms'])
+        total['histogram'] = [a + b for a, b in zip(total['histogram'],
+                                                     entry['histogram'])]
+        total['counts'].update(entry['counts'])
+    return into
+
+
+def _hook(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    try:
+        name = '{}.{}'.format(service, call)
+        counts[name] += 1
+        if service == 'datastore_v3':
+            if call in ('Get', 'Delete'):
+                counts[name + '.keys'] += request.key_size()
+            elif call == 'Put':
+                counts[name + '.entities'] += request.entity_size()
+            elif call in ('RunQuery', 'Next'):
+                counts[name + '.results'] += response.result_size()
+        elif service == 'memcache' and call == 'Get':
+            hits = response.item_size()
+            counts['memcache.hits'] += hits
+            counts['memcache.misses'] += request.key_size() - hits
+    except Exception:
+        logging.exception('Could not record %s.%s', service, call)
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('stats', _hook)
+
+
+def count(name, value=1):
+    """Adds value to a named count of the endpoint call being served, if
+    any, such as the hits and misses of cache.py's tiers"""
+    counts = getattr(_local, 'counts', None)
+    if counts is not None:
+        counts[name] += value
+
+
+def instrument(method):
+    """Decorates an endpoint method to record its calls, errors, latency
+    and the RPCs it makes"""
+    @functools.wraps(method)
+    def wrapper(self, request):
+        if getattr(_local, 'counts', None) is not None:
+            return method(self, request)
+        counts = _local.counts = collections.Counter()
+        error = False
+        start = time.time()
+        try:
+            return method(self, request)
+        except Exception:
+            error = True
+            raise
+        finally:
+            elapsed_ms = (time.time() - start) * 1000
+            _local.counts = None
+            _record(method.__name__, elapsed_ms, error, counts)
+            if time.time() - _last_flush[0] >= FLUSH_INTERVAL:
+                flush()
+    return wrapper
+
+
+def _record(name, elapsed_ms, error, counts):
+    with _lock:
+        entry = _registry.setdefault(name, _new_entry())
+        entry['calls'] += 1
+        entry['errors'] += error
+        entry['total_ms'] += elapsed_ms
+        entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+        entry['histogram'][bisect.bisect_left(LATENCY_BUCKETS_MS,
+                                              elapsed_ms)] += 1
+        entry['counts'].update(counts)
+
+
+def _minute(now):
+    return int(now // 60)
+
+
+def flush():
+    """Adds this instance's counts to the current minute's memcache entry
+    and empties the registry. Counts that cannot be added are kept for the
+    next flush"""
+    now = time.time()
+    with _lock:
+        entries = dict(_registry)
+        _registry.clear()
+        _last_flush[0] = now
+    if not entries:
+        return
+    key = '{}{}'.format(MEMCACHE_PREFIX, _minute(now))
+    client = memcache.Client()
+    for _ in range(FLUSH_RETRIES):
+        current = client.gets(key)
+        if current is None:
+            if memcache.add(key, entries, time=MEMCACHE_TIME):
+                return
+        elif client.cas(key, _merge(current, entries), time=MEMCACHE_TIME):
+            return
+    logging.warning('Could not flush endpoint stats; keeping them')
+    with _lock:
+        _merge(_registry, entries)
+
+
+def _percentile(entry, fraction):
+    wanted = entry['calls'] * fraction
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, entry['histogram']):
+        seen += count
+        if seen >= wanted:
+            return float(min(bound, entry['max_ms']))
+    return entry['max_ms']
+
+
+def get_stats(minutes=WINDOW_MINUTES):
+    """Returns a StatsForm of every endpoint's statistics over the last
+    minutes, across instances. Latency percentiles are the upper bounds of
+    their histogram buckets"""
+    flush()
+    now = _minute(time.time())
+    keys = ['{}{}'.format(MEMCACHE_PREFIX, minute)
+            for minute in range(now - minutes + 1, now + 1)]
+    totals = {}
+    for entries in memcache.get_multi(keys).values():
+        _merge(totals, entries)
+    forms = []
+    for name, entry in sorted(totals.items()):
+        forms.append(EndpointStatsForm(
+            name=name,
+            calls=entry['calls'],
+            errors=entry['errors'],
+            mean_ms=entry['total_ms'] / entry['calls'],
+            p50_ms=_percentile(entry, 0.5),
+            p99_ms=_percentile(entry, 0.99),
+            max_ms=entry['max_ms'],
+            counts=[RpcCountForm(name=count_name, count=count)
+                    for count_name, count
+                    in sorted(entry['counts'].items())]))
+    return StatsForm(minutes=minutes, endpoints=forms)
@@ -1,21 +1,23 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that a urlsafe key string encodes, without
+        fetching the entity. Checks that the key is of the expected kind.
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The Key the urlsafe string encodes.
     Raises:
         ValueError:"""
     try:
@@ -28,9 +30,43 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
+    if key.kind() != model._get_kind():
         raise ValueError('Incorrect Kind')
-    return entity
+    return key
+
+
+def clamp_page_size(page_size):
+    """Returns the page size to use for a requested page_size, which may be
+    None"""
+    return min(max(page_size or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+
+
+def fetch_page(query, page_size, cursor):
+    """Fetches one page of a query with a single bounded datastore query.
+    Args:
+        query: The ndb.Query to page through
+        page_size: The number of results wanted; clamped to MAX_PAGE_SIZE
+        cursor: The urlsafe cursor a previous page returned, or None for the
+            first page
+    Returns:
+        A (results, next_cursor) tuple. next_cursor is the urlsafe cursor of
+        the following page, or None if this is the last page.
+    Raises:
+        BadRequestException: if the cursor is malformed"""
+    return fetch_page_async(query, page_size, cursor).get_result()
+
+
+@ndb.tasklet
+def fetch_page_async(query, page_size, cursor):
+    """Asynchronous fetch_page: returns a Future of its result, so the query
+    can run alongside other lookups"""
+    page_size = clamp_page_size(page_size)
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid cursor')
+    results, next_cursor, more = yield query.fetch_page_async(
+        page_size, start_cursor=start_cursor)
+    if more and next_cursor:
+        raise ndb.Return((results, next_cursor.urlsafe()))
+    raise ndb.Return((results, None))
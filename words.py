@@ -0,0 +1,92 @@
+"""words.py - The pool of secret words new games are started with.
+
+Words are read once per instance from a WordSource and packed into one
+string per word length. Every word in a bucket has the same length, so the
+n-th word starts at offset n * length and a random word is one slice, with
+no network I/O."""
+
+import os
+import random
+import threading
+
+MIN_WORD_LENGTH = 10
+MAX_WORD_LENGTH = 20
+DEFAULT_WORDS_FILE = os.path.join(os.path.dirname(__file__), 'words.txt')
+
+
+class WordSource(object):
+    """Supplies the words for a WordPool. Subclasses override words()"""
+
+    def words(self):
+        """Returns an iterable of words; case and length are not checked"""
+        raise NotImplementedError
+
+
+class FileWordSource(WordSource):
+    """Reads one word per line from a text file"""
+
+    def __init__(self, path=DEFAULT_WORDS_FILE):
+        self.path = path
+
+    def words(self):
+        with open(self.path) as f:
+            for line in f:
+                yield line.strip()
+
+
+class WordPool(object):
+    """Words from a WordSource, bucketed by length into packed buffers"""
+
+    def __init__(self, source):
+        buckets = {}
+        for word in source.words():
+            word = word.upper()
+            if (MIN_WORD_LENGTH <= len(word) <= MAX_WORD_LENGTH and
+                    word.isalpha()):
+                buckets.setdefault(len(word), []).append(word)
+        self._buffers = dict((length, ''.join(bucket))
+                             for length, bucket in buckets.items())
+
+    def count(self, length):
+        """Returns the number of words of the given length"""
+        return len(self._buffers.get(length, '')) // length
+
+    def word(self, length, index):
+        """Returns the index-th word of the given length"""
+        start = index * length
+        return self._buffers[length][start:start + length]
+
+    def random_word(self, length):
+        """Returns a random word of the given length"""
+        count = self.count(length)
+        if not count:
+            raise ValueError('No words of length {}.'.format(length))
+        return self.word(length, random.randrange(count))
+
+
+_source = FileWordSource()
+_pool = None
+_lock = threading.Lock()
+
+
+def set_source(source):
+    """Replaces the WordSource; the pool is reloaded on next use"""
+    global _source, _pool
+    with _lock:
+        _source = source
+        _pool = None
+
+
+def get_pool():
+    """Returns this instance's WordPool, loading it on first use"""
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = WordPool(_source)
+    return _pool
+
+
+def random_word(length):
+    """Returns a random word of the given length from the shared pool"""
+    return get_pool().random_word(length)